@@ -0,0 +1,259 @@
+########### Benchmarks of the 2D and 3D dispersion image code against explicit cross-correlation of every receiver pair,
+########### on synthetic dispersive surface-wave noise. Run as a script: python benchmarkDispImg.py --help
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import sys
+import time
+import json
+import argparse
+import tracemalloc
+import numpy as np
+import traceClass as tr
+import fastDispImg2D as fdi2
+import fastDispImg3D as fdi3
+
+
+
+######### synthetic data ##########
+
+def syntheticArray(nRec, nSamples, dt, layout='linear', spacing=10.0, nSources=20, c0=800.0, f0=10.0, exponent=0.5, noiseLevel=0.1, seed=0):
+	'''Make nSamples samples (spaced dt seconds apart) of ambient surface-wave noise recorded by nRec receivers spacing meters apart, either on a line (layout 'linear') or on a square grid filled row by row (layout 'grid'). The noise is the sum of nSources plane waves with random spectra arriving from random directions (along the line for a linear array) with the dispersive phase velocity c0*(f/f0)**(-exponent) m/s, plus incoherent noise of relative amplitude noiseLevel. This returns a tuple (data, x, y) of the nRec x nSamples numpy array of real data and the 1D numpy arrays of receiver positions (m).'''
+
+	rng = np.random.default_rng(seed)
+	if(layout == 'linear'):
+		x = spacing*np.arange(nRec)
+		y = np.zeros(nRec)
+		azimuths = np.pi*rng.integers(0,2,nSources)
+	else:
+		nPerRow = int(np.ceil(np.sqrt(nRec)))
+		x = spacing*(np.arange(nRec) % nPerRow)
+		y = spacing*(np.arange(nRec) // nPerRow)
+		azimuths = rng.uniform(0,2*np.pi,nSources)
+
+	# slowness (s/m) of the surface waves at each non-negative frequency
+	frqs = np.fft.rfftfreq(nSamples,dt)
+	slowness = (frqs/f0)**exponent/c0
+
+	# each plane wave delays its random spectrum by its slowness times the distance travelled along its direction
+	spec = np.zeros((nRec,frqs.size),dtype=complex)
+	for azimuth in azimuths:
+		sourceSpec = rng.standard_normal(frqs.size)+1j*rng.standard_normal(frqs.size)
+		distance = x*np.cos(azimuth)+y*np.sin(azimuth)
+		spec += sourceSpec*np.exp(-2*np.pi*1j*np.outer(distance,frqs*slowness))
+	data = np.fft.irfft(spec,nSamples,axis=1)
+	data += noiseLevel*data.std()*rng.standard_normal(data.shape)
+	return data, x, y
+
+
+
+######### explicit reference implementations ##########
+
+def bandOf(data, dt, minFreq, maxFreq):
+	'''Get the positive band-limited spectra (nRec x nFrq) and their frequencies (Hz) of the nRec x nSamples real data, taken straight from a full FFT so they check the spectrum code of the fast path too (only the band indices and frequencies come from traceClass.frequencyGrid)'''
+	grid = tr.frequencyGrid()
+	grid.dt = dt
+	grid.nSamples = data.shape[1]
+	minFrqIdx = grid.getIdxFromHz(minFreq)
+	maxFrqIdx = grid.getIdxFromHz(maxFreq)
+	return np.fft.rfft(data,axis=1)[:,minFrqIdx:maxFrqIdx]/data.shape[1], grid.getPosFrqs(minFrqIdx,maxFrqIdx)
+
+def directSigma2D(data, dt, x, velocities, minFreq, maxFreq):
+	'''Reference sigma (nVel x nFrq, positive band) summed one receiver at a time'''
+	specs, frqs = bandOf(data, dt, minFreq, maxFreq)
+	sigma = np.zeros((velocities.size,frqs.size),dtype=complex)
+	for r in range(x.size):
+		sigma += specs[r,:]*np.exp(2*np.pi*1j*x[r]*np.outer(1.0/velocities,frqs))
+	return sigma
+
+def directSigma3D(data, dt, x, y, xvelocities, yvelocities, minFreq, maxFreq):
+	'''Reference sigma (nxVel x nyVel x nFrq, positive band) summed one receiver at a time'''
+	specs, frqs = bandOf(data, dt, minFreq, maxFreq)
+	sigma = np.zeros((xvelocities.size,yvelocities.size,frqs.size),dtype=complex)
+	for r in range(x.size):
+		phaseX = np.exp(2*np.pi*1j*x[r]*np.outer(1.0/xvelocities,frqs))
+		phaseY = np.exp(2*np.pi*1j*y[r]*np.outer(1.0/yvelocities,frqs))
+		sigma += specs[r,:]*phaseX[:,np.newaxis,:]*phaseY[np.newaxis,:,:]
+	return sigma
+
+def crossCorrelationStack2D(data, dt, x, velocities, minFreq, maxFreq):
+	'''Reference dispersion image stack (nVel x nFrq): cross-correlate every virtual source with every receiver (as cross-spectra), slant-stack each virtual source gather over the offsets and stack the absolute values over virtual sources, folding in the negative frequencies'''
+	specs, frqs = bandOf(data, dt, minFreq, maxFreq)
+	stack = np.zeros((velocities.size,frqs.size))
+	slownessFrqs = np.outer(1.0/velocities,frqs)
+	for s in range(x.size):
+		crossSpecs = np.conj(specs[s,:])*specs # nRec x nFrq cross-correlations with virtual source s
+		image = np.zeros((velocities.size,frqs.size),dtype=complex)
+		for r in range(x.size):
+			image += crossSpecs[r,:]*np.exp(2*np.pi*1j*(x[r]-x[s])*slownessFrqs)
+		stack += 2*np.absolute(image)
+	return stack
+
+def crossCorrelationStack3D(data, dt, x, y, xvelocities, yvelocities, minFreq, maxFreq):
+	'''Reference 3D dispersion image stack (nxVel x nyVel x nFrq), as crossCorrelationStack2D but slant-stacking over both offset directions'''
+	specs, frqs = bandOf(data, dt, minFreq, maxFreq)
+	stack = np.zeros((xvelocities.size,yvelocities.size,frqs.size))
+	slownessFrqsX = np.outer(1.0/xvelocities,frqs)
+	slownessFrqsY = np.outer(1.0/yvelocities,frqs)
+	for s in range(x.size):
+		crossSpecs = np.conj(specs[s,:])*specs
+		image = np.zeros((xvelocities.size,yvelocities.size,frqs.size),dtype=complex)
+		for r in range(x.size):
+			phaseX = np.exp(2*np.pi*1j*(x[r]-x[s])*slownessFrqsX)
+			phaseY = np.exp(2*np.pi*1j*(y[r]-y[s])*slownessFrqsY)
+			image += crossSpecs[r,:]*phaseX[:,np.newaxis,:]*phaseY[np.newaxis,:,:]
+		stack += 2*np.absolute(image)
+	return stack
+
+
+
+######### measurements ##########
+
+def measure(function, *args, **kwargs):
+	'''Call function(*args, **kwargs) once and return a tuple (seconds, peakBytes, result) of the wall-clock time and of the peak memory allocated during the call, as traced by tracemalloc (numpy reports its arrays to it)'''
+	tracemalloc.start()
+	start = time.perf_counter()
+	result = function(*args, **kwargs)
+	seconds = time.perf_counter()-start
+	peakBytes = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return seconds, peakBytes, result
+
+def relativeError(a, b):
+	'''Get the largest absolute difference between the arrays a and b relative to the largest absolute value of b'''
+	return np.max(np.absolute(a-b))/np.max(np.absolute(b))
+
+def passFilterFunc(someTrace):
+	''' This is a filter function that does nothing'''
+	pass
+
+
+
+def benchmark2D(nRec, nSamples, dt, nVel, minFreq, maxFreq, reference=True):
+	'''Time sigma2D and dispImgStack2D on a synthetic linear array (and, if reference is True, their explicit counterparts) and return one row of results as a dict'''
+	data, x = syntheticArray(nRec, nSamples, dt, 'linear')[:2]
+	velocities = np.linspace(200,2000,nVel)
+	gather = tr.TraceGather(data,dt,x)
+	row = {'case':'2D', 'nRec':nRec, 'nVel':nVel}
+
+	row['sigmaTime'], row['sigmaPeak'], sigma = measure(fdi2.sigma2D, gather, velocities, minFreq, maxFreq, passFilterFunc, oneSided=True)
+	row['stackTime'], row['stackPeak'], stack = measure(fdi2.dispImgStack2D, gather, velocities, minFreq, maxFreq, passFilterFunc)
+	row['nFrq'] = sigma.shape[1]
+	if(reference):
+		row['refSigmaTime'], row['refSigmaPeak'], refSigma = measure(directSigma2D, data, dt, x, velocities, minFreq, maxFreq)
+		row['refStackTime'], row['refStackPeak'], refStack = measure(crossCorrelationStack2D, data, dt, x, velocities, minFreq, maxFreq)
+		row['sigmaError'] = relativeError(sigma, refSigma)
+		row['stackError'] = relativeError(stack, refStack)
+	return row
+
+def benchmark3D(nRec, nSamples, dt, nVel, minFreq, maxFreq, reference=True):
+	'''Time sigma3D and dispImgStack3D on a synthetic square grid of receivers with nVel x nVel velocities (and, if reference is True, their explicit counterparts) and return one row of results as a dict'''
+	data, x, y = syntheticArray(nRec, nSamples, dt, 'grid')
+	velocities = np.linspace(200,2000,nVel)
+	gather = tr.TraceGather(data,dt,x,y)
+	row = {'case':'3D', 'nRec':nRec, 'nVel':nVel}
+
+	row['sigmaTime'], row['sigmaPeak'], sigma = measure(fdi3.sigma3D, gather, velocities, velocities, minFreq, maxFreq, passFilterFunc, oneSided=True)
+	row['stackTime'], row['stackPeak'], stack = measure(fdi3.dispImgStack3D, gather, velocities, velocities, minFreq, maxFreq, passFilterFunc)
+	row['nFrq'] = sigma.shape[2]
+	if(reference):
+		row['refSigmaTime'], row['refSigmaPeak'], refSigma = measure(directSigma3D, data, dt, x, y, velocities, velocities, minFreq, maxFreq)
+		row['refStackTime'], row['refStackPeak'], refStack = measure(crossCorrelationStack3D, data, dt, x, y, velocities, velocities, minFreq, maxFreq)
+		row['sigmaError'] = relativeError(sigma, refSigma)
+		row['stackError'] = relativeError(stack, refStack)
+	return row
+
+
+
+def printRow(row):
+	'''Print one row of benchmark results'''
+	line = '%-3s nRec %6d  nVel %4d  nFrq %5d | sigma %8.3f s %8.1f MB | stack %8.3f s %8.1f MB' % (row['case'], row['nRec'], row['nVel'], row['nFrq'], row['sigmaTime'], row['sigmaPeak']/2**20, row['stackTime'], row['stackPeak']/2**20)
+	if 'refStackTime' in row:
+		line += ' | cross-correlation %8.3f s %8.1f MB  speedup %7.1fx  error %.1e' % (row['refStackTime'], row['refStackPeak']/2**20, row['refStackTime']/row['stackTime'], max(row['sigmaError'],row['stackError']))
+	print(line)
+	sys.stdout.flush()
+
+
+
+def compareToBaseline(rows, baselineRows, slowdown, memoryGrowth, minSeconds=0.0):
+	'''Compare the timings and peak memory of rows with those of the same cases (same case, nRec and nVel) in baselineRows, rows saved by an earlier run. This returns a list of messages, one per time more than slowdown times (and minSeconds seconds) slower than its baseline and per peak more than memoryGrowth times its baseline; cases missing from the baseline are skipped.'''
+	baseline = {(row['case'],row['nRec'],row['nVel']):row for row in baselineRows}
+	regressions = []
+	for row in rows:
+		old = baseline.get((row['case'],row['nRec'],row['nVel']))
+		if old is None:
+			continue
+		name = '%s nRec %d nVel %d' % (row['case'],row['nRec'],row['nVel'])
+		for key in ('sigmaTime','stackTime'):
+			if(key in old and row[key] > slowdown*old[key] and row[key]-old[key] > minSeconds):
+				regressions.append('%s: %s %.3f s is %.2fx the baseline %.3f s' % (name,key,row[key],row[key]/old[key],old[key]))
+		for key in ('sigmaPeak','stackPeak'):
+			if(key in old and row[key] > memoryGrowth*old[key]):
+				regressions.append('%s: %s %.1f MB is %.2fx the baseline %.1f MB' % (name,key,row[key]/2**20,row[key]/old[key],old[key]/2**20))
+	return regressions
+
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Benchmark the fast 2D/3D dispersion images against explicit cross-correlation of every receiver pair on synthetic data.')
+	parser.add_argument('--receivers', type=int, nargs='+', default=[50,100,200,400,800], help='receiver counts of the 2D scaling curve (the 3D curve uses the largest perfect square at most each count, capped at 400)')
+	parser.add_argument('--velocities', type=int, nargs='+', default=[25,50,100,200], help='velocity grid sizes of the grid-size scaling curve')
+	parser.add_argument('--samples', type=int, default=2000, help='samples per trace')
+	parser.add_argument('--dt', type=float, default=0.004, help='time between samples (s)')
+	parser.add_argument('--band', type=float, nargs=2, default=[2.0,30.0], help='minimum and maximum frequency (Hz)')
+	parser.add_argument('--reference-limit', type=int, default=200, help='largest receiver count to also run the explicit cross-correlation reference on')
+	parser.add_argument('--tolerance', type=float, default=1e-8, help='largest relative difference to the reference before the run fails')
+	parser.add_argument('--quick', action='store_true', help='only run a small case of each kind, for a fast regression check')
+	parser.add_argument('--save', help='write the rows of results to this JSON file, to be used as a later --baseline')
+	parser.add_argument('--baseline', help='JSON file of rows saved by an earlier run (--save); the run fails if a case is slower or takes more memory than allowed below')
+	parser.add_argument('--slowdown', type=float, default=1.5, help='largest ratio of a time to its baseline before the run fails')
+	parser.add_argument('--memory-growth', type=float, default=1.1, help='largest ratio of a peak memory to its baseline before the run fails')
+	parser.add_argument('--min-seconds', type=float, default=0.01, help='slowdowns by fewer seconds than this are put down to timer noise')
+	args = parser.parse_args(argv)
+
+	minFreq, maxFreq = args.band
+	receiverCounts = args.receivers[:2] if args.quick else args.receivers
+	velocityCounts = args.velocities[:1] if args.quick else args.velocities
+	rows = []
+
+	print('### scaling with the number of receivers')
+	for nRec in receiverCounts:
+		rows.append(benchmark2D(nRec, args.samples, args.dt, velocityCounts[0], minFreq, maxFreq, nRec <= args.reference_limit))
+		printRow(rows[-1])
+	for nRec in sorted(set(min(400,int(np.sqrt(n))**2) for n in receiverCounts)):
+		rows.append(benchmark3D(nRec, args.samples, args.dt, max(5,velocityCounts[0]//2), minFreq, maxFreq, nRec <= args.reference_limit//4))
+		printRow(rows[-1])
+
+	print('### scaling with the size of the velocity grid')
+	for nVel in velocityCounts:
+		rows.append(benchmark2D(receiverCounts[0], args.samples, args.dt, nVel, minFreq, maxFreq, receiverCounts[0] <= args.reference_limit))
+		printRow(rows[-1])
+	for nVel in velocityCounts:
+		rows.append(benchmark3D(min(100,receiverCounts[0]), args.samples, args.dt, max(5,nVel//2), minFreq, maxFreq, False))
+		printRow(rows[-1])
+
+	if args.save is not None:
+		with open(args.save,'w') as f:
+			json.dump(rows,f,indent=1)
+
+	# a disagreement with the reference, or a slowdown or memory growth against the baseline, fails the run, so it can guard deployments
+	failed = False
+	errors = [max(row['sigmaError'],row['stackError']) for row in rows if 'sigmaError' in row]
+	if(errors and max(errors) > args.tolerance):
+		print('FAILED: relative difference to the reference %.1e is above %.1e' % (max(errors),args.tolerance))
+		failed = True
+	else:
+		print('all %d reference checks agree to %.1e' % (len(errors),max(errors+[0.0])))
+	if args.baseline is not None:
+		with open(args.baseline) as f:
+			regressions = compareToBaseline(rows, json.load(f), args.slowdown, args.memory_growth, args.min_seconds)
+		for regression in regressions:
+			print('FAILED: '+regression)
+		if not regressions:
+			print('no case is more than %.2fx slower or takes more than %.2fx the memory of the baseline' % (args.slowdown,args.memory_growth))
+		failed = failed or bool(regressions)
+	return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
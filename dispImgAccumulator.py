@@ -0,0 +1,172 @@
+########### Code for keeping sigma and dispersion image stacks up to date as receivers and time windows come and go.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import copy
+import numpy as np
+import traceClass as tr
+import fastDispImg2D as fdi2
+import fastDispImg3D as fdi3
+
+
+
+class SigmaAccumulator(tr.frequencyGrid):
+	'''Running sums behind a stack of dispersion images over time windows. Each window keeps its own one-sided sigma, the summed amplitude spectra of its virtual sources, its stacked image and the positions and a short checksum of the band-limited spectrum of each of its receivers (and, if keepSpectra, the spectra themselves), so adding or removing receivers only recomputes their terms and the image of the windows they belong to. Subclasses define the sigma terms and the image (see SigmaAccumulator2D and SigmaAccumulator3D).'''
+
+
+	def __init__(self, dt, nSamples, minFreq, maxFreq, keepSpectra=True):
+		'''dt is the time (s) between samples and nSamples the length of every time window (int). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). If keepSpectra is True the band-limited spectrum of every receiver of every window is kept, so receivers can be removed by name alone; this takes nWindows x nRec x nFrq complex numbers, so with many windows set it to False and pass the trace to removeReceiver instead.'''
+		self.keepSpectra = keepSpectra # whether the spectra of the receivers are kept for removeReceiver
+		self.dt = dt # time (s) between samples
+		self.nSamples = nSamples # length of each window
+		self.minFreq = minFreq # band of interest (Hz)
+		self.maxFreq = maxFreq
+		self.minFrqIdx = self.getIdxFromHz(minFreq)
+		self.maxFrqIdx = self.getIdxFromHz(maxFreq)
+		self.posFrqs = self.getPosFrqs(self.minFrqIdx,self.maxFrqIdx) # positive frequencies (Hz) of sigma and the stack
+		self.windows = {} # windowId -> running sums of that window
+		self.nextWindowId = 0
+		self.dispImgStack = np.zeros(self.imageShape()) # image stacked over all virtual sources and windows
+
+
+	def addWindow(self, traces, filterFunction, receiverIds=None, windowId=None):
+		'''traces is a list of trace objects or a traceClass.TraceGather holding one time window of nSamples real samples per receiver, and filterFunction is a user-defined filter called as in fastDispImg2D.sigma2D. receiverIds are hashable names of the receivers used to remove them later (by default 0,...,nRec-1) and windowId names this window (by default a new integer). This adds the window to the stack and returns its windowId.'''
+		self.checkGrid(traces if isinstance(traces,tr.TraceGather) else traces[0])
+		posSpecs, x, y, posFrqs = tr.bandSpectra(traces, self.minFreq, self.maxFreq, filterFunction, oneSided=True)
+		if receiverIds is None:
+			receiverIds = list(range(posSpecs.shape[0]))
+		if windowId is None:
+			windowId = self.nextWindowId
+		if windowId in self.windows:
+			raise ValueError("window "+str(windowId)+" was already added")
+		if isinstance(windowId,int):
+			self.nextWindowId = max(self.nextWindowId,windowId+1)
+		self.windows[windowId] = {'receivers':{}, 'sigma':np.zeros(self.sigmaShape(),dtype=complex), 'amplitudes':np.zeros(self.posFrqs.size), 'image':np.zeros(self.imageShape())}
+		self.updateTerms(windowId, receiverIds, posSpecs, x, y, 1)
+		return windowId
+
+	def removeWindow(self, windowId):
+		'''Remove the window windowId and its whole contribution from the stack'''
+		window = self.windows.pop(windowId)
+		self.dispImgStack -= window['image']
+
+	def addReceiver(self, windowId, receiverId, aTrace, filterFunction):
+		'''Add the trace object aTrace (with nSamples samples) filtered by filterFunction as receiver receiverId of the window windowId, updating only its terms. A copy of aTrace is filtered, so aTrace itself is left as it was.'''
+		self.checkGrid(aTrace)
+		if receiverId in self.windows[windowId]['receivers']:
+			raise ValueError("receiver "+str(receiverId)+" is already in window "+str(windowId))
+		posSpec = self.filteredPosSpec(aTrace, filterFunction)
+		self.updateTerms(windowId, [receiverId], posSpec[np.newaxis,:], np.array([aTrace.x]), np.array([aTrace.y]), 1)
+
+	def removeReceiver(self, receiverId, windowId=None, aTrace=None, filterFunction=None):
+		'''Remove receiver receiverId (for example a channel rejected by QC) from the window windowId, or from every window it is in if windowId is None, updating only its terms. If the spectra are not kept (see keepSpectra), aTrace must be the trace object of this receiver in the window windowId and filterFunction the filter it was added with, so its terms can be recomputed and subtracted. aTrace may be the raw trace (a copy of it is filtered) or the trace already filtered by filterFunction (for example the one passed to addWindow, or TraceGather.getTrace of a gather passed to addWindow), which is used as it is. A ValueError is raised if neither matches the spectrum the receiver was added with.'''
+		if aTrace is not None:
+			if windowId is None:
+				raise ValueError("the window of aTrace must be given")
+			self.checkGrid(aTrace)
+			x, y, check = self.windows[windowId]['receivers'][receiverId][1:]
+			posSpec = self.filteredPosSpec(aTrace, filterFunction)
+			if not self.matchesCheck(posSpec, check):
+				posSpec = aTrace.getPosSpec(self.minFrqIdx,self.maxFrqIdx)
+				if not self.matchesCheck(posSpec, check):
+					raise ValueError("aTrace does not match the spectrum receiver "+str(receiverId)+" was added to window "+str(windowId)+" with, raw or filtered by filterFunction")
+			self.updateTerms(windowId, [receiverId], posSpec[np.newaxis,:], np.array([x]), np.array([y]), -1)
+			return
+		windowIds = [windowId] if windowId is not None else [w for w in self.windows if receiverId in self.windows[w]['receivers']]
+		for w in windowIds:
+			posSpec, x, y = self.windows[w]['receivers'][receiverId][:3]
+			if posSpec is None:
+				raise ValueError("spectra are not kept (keepSpectra is False), so the trace of receiver "+str(receiverId)+" must be given")
+			self.updateTerms(w, [receiverId], posSpec[np.newaxis,:], np.array([x]), np.array([y]), -1)
+
+	def getSigma(self, windowId):
+		'''Get the one-sided sigma of the window windowId (use traceClass.posNegFromPos for the positive and negative band)'''
+		return self.windows[windowId]['sigma']
+
+	def getDispImgStack(self):
+		'''Get a copy of the dispersion image stacked over all virtual sources and windows, in the order minFreq,...,maxFreq along the last axis'''
+		return self.dispImgStack.copy()
+
+
+	def updateTerms(self, windowId, receiverIds, posSpecs, x, y, sign):
+		'''Add (sign 1) or subtract (sign -1) the receivers receiverIds with band-limited spectra posSpecs (nRec x nFrq) and positions x, y to the window windowId, then replace that window's image in the stack'''
+		window = self.windows[windowId]
+		window['sigma'] += sign*self.sigmaTerms(posSpecs, x, y)
+		window['amplitudes'] += sign*tr.sumAmplitudeSpectra(posSpecs)
+		for i, rid in enumerate(receiverIds):
+			if(sign > 0):
+				window['receivers'][rid] = (posSpecs[i,:].copy() if self.keepSpectra else None, x[i], y[i], spectrumCheck(posSpecs[i,:]))
+			else:
+				del window['receivers'][rid]
+		self.dispImgStack -= window['image']
+		window['image'] = self.image(window['sigma'], window['amplitudes'])
+		self.dispImgStack += window['image']
+
+	def filteredPosSpec(self, aTrace, filterFunction):
+		'''Get the band-limited spectrum of a copy of the trace object aTrace filtered by filterFunction, leaving aTrace as it was'''
+		filtered = copy.deepcopy(aTrace)
+		filterFunction(filtered) # call user-defined filters
+		return filtered.getPosSpec(self.minFrqIdx,self.maxFrqIdx)
+
+	def matchesCheck(self, posSpec, check, tolerance=1e-5):
+		'''Whether the band-limited spectrum posSpec has the checksum check (from spectrumCheck) to within tolerance relative to its amplitude'''
+		newCheck = spectrumCheck(posSpec)
+		return bool(np.all(np.absolute(newCheck[:2]-check[:2]) <= tolerance*max(newCheck[2].real,check[2].real)))
+
+	def checkGrid(self, ref):
+		'''Make sure the trace or gather ref has the sampling of this accumulator'''
+		if(ref.nSamples != self.nSamples or ref.dt != self.dt):
+			raise ValueError("traces must have nSamples="+str(self.nSamples)+" samples spaced dt="+str(self.dt)+" s apart")
+		if(ref.frqRefinement != self.frqRefinement):
+			raise ValueError("traces must have frqRefinement="+str(self.frqRefinement))
+
+
+
+class SigmaAccumulator2D(SigmaAccumulator):
+
+
+	def __init__(self, dt, nSamples, velocities, minFreq, maxFreq, keepSpectra=True):
+		'''dt is the time (s) between samples and nSamples the length of every time window (int). velocities are a 1D numpy array of velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz), and keepSpectra is as in SigmaAccumulator. The stack is nVel x nFrq as returned by fastDispImg2D.dispImgStack2D.'''
+		self.velocities = velocities
+		SigmaAccumulator.__init__(self, dt, nSamples, minFreq, maxFreq, keepSpectra)
+
+	def sigmaShape(self):
+		return (self.velocities.size,self.posFrqs.size)
+
+	def imageShape(self):
+		return (self.velocities.size,self.posFrqs.size)
+
+	def sigmaTerms(self, posSpecs, x, y):
+		return fdi2.sigma2DFromSpecs(posSpecs, x, self.velocities, self.posFrqs)
+
+	def image(self, sigma, amplitudes):
+		return fdi2.dispImgStack2DFromAmplitudes(amplitudes, sigma, oneSided=True)
+
+
+
+class SigmaAccumulator3D(SigmaAccumulator):
+
+
+	def __init__(self, dt, nSamples, xvelocities, yvelocities, minFreq, maxFreq, keepSpectra=True):
+		'''dt is the time (s) between samples and nSamples the length of every time window (int). xvelocities and yvelocities are 1D numpy arrays of velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz), and keepSpectra is as in SigmaAccumulator. The stack is nxVel x nyVel x nFrq as returned by fastDispImg3D.dispImgStack3D.'''
+		self.xvelocities = xvelocities
+		self.yvelocities = yvelocities
+		SigmaAccumulator.__init__(self, dt, nSamples, minFreq, maxFreq, keepSpectra)
+
+	def sigmaShape(self):
+		return (self.xvelocities.size,self.yvelocities.size,self.posFrqs.size)
+
+	def imageShape(self):
+		return (self.xvelocities.size,self.yvelocities.size,self.posFrqs.size)
+
+	def sigmaTerms(self, posSpecs, x, y):
+		return fdi3.sigma3DFromSpecs(posSpecs, x, y, self.xvelocities, self.yvelocities, self.posFrqs)
+
+	def image(self, sigma, amplitudes):
+		return fdi3.dispImgStack3DFromAmplitudes(amplitudes, sigma, oneSided=True)
+
+
+
+def spectrumCheck(posSpec):
+	'''Get a short checksum of the 1D band-limited spectrum posSpec, to recognize it again without keeping it: a 1D numpy array of its sum, its sum weighted by a ramp over the band and the sum of its amplitudes'''
+	ramp = np.linspace(0,1,posSpec.size)
+	return np.array([np.sum(posSpec), np.dot(ramp,posSpec), np.sum(np.absolute(posSpec))],dtype=complex)
@@ -0,0 +1,92 @@
+########### Code for caching the frequency grids and phase shifts shared by repeated dispersion images of the same array.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+# default memory (bytes) the shared cache may hold
+defaultCacheBytes = 2**27
+
+
+
+class PhaseShiftCache:
+	'''Least-recently-used cache of the setup that only depends on the sampling (dt, nSamples), the band, the velocity grid and the receiver positions: frequency grids, per-receiver phase shift vectors (see fastDispImg2D.receiverPhaseShifts) and, when one is passed to sigma2D/sigma3D or the stacks, the phase shift blocks of sigma. Entries are evicted, least recently used first, once they take more than maxBytes bytes together, and an entry larger than maxBytes is recomputed on every call rather than stored (so maxBytes=0 turns caching off). Cached arrays are shared between calls and must not be modified. It can be used from several threads at once.'''
+
+
+	def __init__(self, maxBytes=defaultCacheBytes):
+		'''maxBytes is the memory (bytes) the cached arrays may take together (int)'''
+		self.maxBytes = maxBytes
+		self.nBytes = 0 # memory held by the cached arrays
+		self.entries = OrderedDict() # key -> (value, nBytes), least recently used first
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def clear(self):
+		'''Drop every cached entry'''
+		with self.lock:
+			self.entries.clear()
+			self.nBytes = 0
+
+	def get(self, key, compute):
+		'''Get the value cached under the hashable key, or call compute() to make it (a numpy array or a tuple/list of them) and cache it'''
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return self.entries[key][0]
+			self.misses += 1
+		value = compute()
+		nBytes = valueBytes(value)
+		if(nBytes <= self.maxBytes):
+			with self.lock:
+				if key not in self.entries:
+					self.entries[key] = (value, nBytes)
+					self.nBytes += nBytes
+				# evict least recently used entries until the rest fits
+				while(self.nBytes > self.maxBytes):
+					oldKey, (oldValue, oldBytes) = self.entries.popitem(last=False)
+					self.nBytes -= oldBytes
+		return value
+
+	def getBlocks(self, key, nBytes, generateBlocks):
+		'''Get the list of blocks cached under key, or make them with the generator function generateBlocks() and cache them. If they would take more than maxBytes (nBytes, estimated by the caller) the generator is returned instead, so the blocks are formed one at a time as before.'''
+		if(nBytes > self.maxBytes):
+			return generateBlocks()
+		return self.get(key, lambda: list(generateBlocks()))
+
+
+	def frequencyGrid(self, ref, minFreq, maxFreq):
+		'''ref is a trace or traceClass.TraceGather and minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). This returns a tuple (minFrqIdx, maxFrqIdx, posFrqs, posNegFrqs) of the band indices and frequencies (Hz) as given by ref.getIdxFromHz, ref.getPosFrqs and ref.getPosNegFrqs.'''
+		def compute():
+			minFrqIdx = ref.getIdxFromHz(minFreq)
+			maxFrqIdx = ref.getIdxFromHz(maxFreq)
+			return (minFrqIdx, maxFrqIdx, ref.getPosFrqs(minFrqIdx,maxFrqIdx), ref.getPosNegFrqs(minFrqIdx,maxFrqIdx))
+		return self.get(('frequencyGrid',ref.dt,ref.nSamples,ref.frqRefinement,minFreq,maxFreq), compute)
+
+
+
+def arrayKey(a):
+	'''Get a hashable key holding the type, shape and contents of the numpy array a'''
+	a = np.asarray(a)
+	return (a.dtype.str, a.shape, a.tobytes())
+
+
+
+def valueBytes(value):
+	'''Get the memory (bytes) of the numpy arrays in value, which may be an array, a number or a (nested) tuple or list of them'''
+	if(isinstance(value,np.ndarray)):
+		return value.nbytes
+	if(isinstance(value,(tuple,list))):
+		return sum(valueBytes(v) for v in value)
+	return 0
+
+
+
+# cache of the frequency grids and virtual source phase shifts shared by all calls that are not given their own (phase shift blocks of sigma are only kept in caches passed explicitly)
+defaultCache = PhaseShiftCache()
@@ -0,0 +1,181 @@
+########### Code for saving sigma, dispersion image stacks and band-limited spectra to disk, so long jobs can resume and stacks from several nodes can be merged.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import os
+import json
+import shutil
+import numpy as np
+import traceClass as tr
+
+
+# version of the checkpoint layout written by Checkpoint.save
+formatVersion = 1
+
+# what a checkpoint can hold
+kinds = ('sigma', 'stack', 'spectra')
+
+
+
+class Checkpoint(tr.frequencyGrid):
+	'''A sigma, a dispersion image stack or the band-limited spectra of a set of receivers, together with what is needed to check that two of them can be combined: the sampling (dt, nSamples), the band, whether only positive frequencies are kept (oneSided), the velocity grids, the receiver positions and the number of time windows summed so far. On disk a checkpoint is a directory holding the array as data.npy (so it can be memory-mapped), the velocity grids and receiver positions as grids.npz and the scalar metadata as meta.json, which is written last so a directory with a meta.json is complete.'''
+
+
+	def __init__(self, kind, data, dt, nSamples, minFreq, maxFreq, x, y=None, velocities=None, xvelocities=None, yvelocities=None, nWindows=1, oneSided=True, frqRefinement=1):
+		'''kind is 'sigma', 'stack' or 'spectra'. data is the numpy array: sigma as returned by fastDispImg2D.sigma2D (nVel x nCols) or fastDispImg3D.sigma3D (nxVel x nyVel x nCols), a stack as returned by the dispImgStack functions (nVel x nFrq or nxVel x nyVel x nFrq), or nRec x nCols band-limited spectra as returned by traceClass.bandSpectra, where nCols is nFrq if oneSided and 2*nFrq otherwise. data may be None to only describe a setup, for example to check a file before resuming from it. dt is the time (s) between samples, nSamples the length of each time window, minFreq and maxFreq the band (Hz), x and y the 1D numpy arrays of the receiver positions (m), velocities the velocities (m/s) of a 2D image or xvelocities and yvelocities those of a 3D one (not needed for spectra), nWindows the number of time windows summed into data and frqRefinement the refinement of the frequency grid of the spectra (see traceClass.trace).'''
+		if kind not in kinds:
+			raise ValueError("kind must be one of "+str(kinds))
+		self.kind = kind
+		self.data = data
+		self.dt = dt # time (s) between samples
+		self.nSamples = nSamples # length of each time window
+		self.minFreq = minFreq # band (Hz)
+		self.maxFreq = maxFreq
+		self.frqRefinement = frqRefinement # frequency bins per bin of the FFT of nSamples samples
+		self.minFrqIdx = self.getIdxFromHz(minFreq)
+		self.maxFrqIdx = self.getIdxFromHz(maxFreq)
+		self.oneSided = bool(oneSided)
+		self.nWindows = nWindows # time windows summed into data
+		x = np.asarray(x,dtype=float)
+		self.grids = {'x':x, 'y':np.zeros(x.size) if y is None else np.asarray(y,dtype=float)}
+		if velocities is not None:
+			self.grids['velocities'] = np.asarray(velocities,dtype=float)
+		if xvelocities is not None:
+			self.grids['xvelocities'] = np.asarray(xvelocities,dtype=float)
+			self.grids['yvelocities'] = np.asarray(yvelocities,dtype=float)
+		if data is not None and data.shape != self.getShape():
+			raise ValueError("data has shape "+str(data.shape)+" but this setup needs "+str(self.getShape()))
+
+	def getShape(self):
+		'''Get the shape data must have for this kind and setup'''
+		nFrq = self.maxFrqIdx-self.minFrqIdx
+		nCols = nFrq if (self.oneSided or self.kind == 'stack') else 2*nFrq
+		if(self.kind == 'spectra'):
+			return (self.grids['x'].size,nCols)
+		if 'velocities' in self.grids:
+			return (self.grids['velocities'].size,nCols)
+		return (self.grids['xvelocities'].size,self.grids['yvelocities'].size,nCols)
+
+	def getMeta(self):
+		'''Get the scalar metadata written to meta.json'''
+		meta = {'formatVersion':formatVersion, 'kind':self.kind, 'dt':self.dt, 'nSamples':self.nSamples, 'minFreq':self.minFreq, 'maxFreq':self.maxFreq, 'frqRefinement':self.frqRefinement, 'minFrqIdx':self.minFrqIdx, 'maxFrqIdx':self.maxFrqIdx, 'oneSided':self.oneSided, 'nWindows':self.nWindows}
+		if self.data is not None:
+			meta['dtype'] = self.data.dtype.str
+			meta['shape'] = list(self.data.shape)
+		return meta
+
+
+	def save(self, path):
+		'''Write this checkpoint to the directory path. It is written to path.tmp first and then swapped in, with the previous checkpoint moved to path.old until the new one is in place, so a job that dies at any point while saving leaves a complete checkpoint that load() and findCheckpoint() find.'''
+		finishSave(path)
+		tmpPath = path+'.tmp'
+		if os.path.exists(tmpPath):
+			shutil.rmtree(tmpPath)
+		os.makedirs(tmpPath)
+		np.save(os.path.join(tmpPath,'data.npy'),np.asarray(self.data))
+		np.savez(os.path.join(tmpPath,'grids.npz'),**self.grids)
+		with open(os.path.join(tmpPath,'meta.json.part'),'w') as f:
+			json.dump(self.getMeta(),f,indent=1)
+		os.replace(os.path.join(tmpPath,'meta.json.part'),os.path.join(tmpPath,'meta.json'))
+
+		# swap the new checkpoint in for the old one
+		oldPath = path+'.old'
+		if os.path.exists(path):
+			if os.path.exists(oldPath):
+				shutil.rmtree(oldPath)
+			os.rename(path,oldPath)
+		os.rename(tmpPath,path)
+		if os.path.exists(oldPath):
+			shutil.rmtree(oldPath)
+
+	@classmethod
+	def load(cls, path, mmapMode='r'):
+		'''Read the checkpoint saved to the directory path, or the complete one a save interrupted by a crash left next to it (see findCheckpoint), raising a FileNotFoundError if there is none. With the default mmapMode 'r' the data are memory-mapped read-only, so a large sigma is only read from disk as it is used; mmapMode None reads them into memory and 'r+' or 'c' are as in numpy.load.'''
+		found = findCheckpoint(path)
+		if found is None:
+			raise FileNotFoundError("no checkpoint saved at "+path)
+		path = found
+		with open(os.path.join(path,'meta.json')) as f:
+			meta = json.load(f)
+		if(meta['formatVersion'] > formatVersion):
+			raise ValueError(path+" was written by a newer version (format "+str(meta['formatVersion'])+")")
+		with np.load(os.path.join(path,'grids.npz')) as f:
+			grids = {name:f[name] for name in f.files}
+		data = np.load(os.path.join(path,'data.npy'),mmap_mode=mmapMode)
+		return cls(meta['kind'], data, meta['dt'], meta['nSamples'], meta['minFreq'], meta['maxFreq'], grids['x'], grids['y'], grids.get('velocities'), grids.get('xvelocities'), grids.get('yvelocities'), meta['nWindows'], meta['oneSided'], meta.get('frqRefinement',1))
+
+
+	def checkCompatible(self, other, samePositions=True):
+		'''Raise a ValueError naming the first difference between the setup of this checkpoint and of the checkpoint other (kind, sampling, frequency grid, band, oneSided, velocity grids and, if samePositions is True, receiver positions), so their data can be summed or one can resume the other'''
+		for name in ('kind','dt','nSamples','frqRefinement','minFrqIdx','maxFrqIdx','oneSided'):
+			if(getattr(self,name) != getattr(other,name)):
+				raise ValueError("checkpoints differ in "+name+": "+str(getattr(self,name))+" and "+str(getattr(other,name)))
+		for name in set(self.grids)|set(other.grids):
+			if(name in ('x','y') and not samePositions):
+				continue
+			if(name not in self.grids or name not in other.grids or not np.array_equal(self.grids[name],other.grids[name])):
+				raise ValueError("checkpoints differ in "+name)
+
+
+
+def isComplete(path):
+	'''Whether the directory path holds a completely written checkpoint'''
+	return os.path.isfile(os.path.join(path,'meta.json'))
+
+
+
+def findCheckpoint(path):
+	'''Get the directory holding the newest complete checkpoint saved to path: path.tmp if a save was interrupted after writing it, path itself, or path.old if a save was interrupted while swapping it out. This returns None if there is none.'''
+	for candidate in (path+'.tmp', path, path+'.old'):
+		if isComplete(candidate):
+			return candidate
+	return None
+
+
+
+def finishSave(path):
+	'''Finish a save to path that was interrupted by a crash, so the newest complete checkpoint is at path itself: a complete path.tmp is swapped in, or path.old is moved back if path is missing'''
+	tmpPath = path+'.tmp'
+	oldPath = path+'.old'
+	if isComplete(tmpPath):
+		if os.path.exists(path):
+			if os.path.exists(oldPath):
+				shutil.rmtree(oldPath)
+			os.rename(path,oldPath)
+		os.rename(tmpPath,path)
+	elif(not os.path.exists(path) and isComplete(oldPath)):
+		os.rename(oldPath,path)
+
+
+
+def mergeCheckpoints(checkpoints):
+	'''checkpoints is a list of Checkpoint objects with the same setup, for example the stacks of different time windows computed on separate nodes. This returns a new Checkpoint whose data are their sum: stacks must share the receivers and their numbers of windows add up, while sigmas must share the windows and are summed over their (distinct) receivers, whose positions are joined. Band-limited spectra cannot be merged.'''
+
+	first = checkpoints[0]
+	if(first.kind == 'spectra'):
+		raise ValueError("band-limited spectra cannot be merged by summation")
+	isStack = (first.kind == 'stack')
+	for other in checkpoints[1:]:
+		first.checkCompatible(other, samePositions=isStack)
+		if(not isStack and other.nWindows != first.nWindows):
+			raise ValueError("sigmas summed over different receivers must cover the same windows")
+
+	# sum in the precision of the inputs, reading memory-mapped data one checkpoint at a time
+	data = np.zeros(first.getShape(),dtype=np.result_type(*[c.data for c in checkpoints]))
+	for c in checkpoints:
+		data += c.data
+	if(isStack):
+		x, y = first.grids['x'], first.grids['y']
+		nWindows = sum(c.nWindows for c in checkpoints)
+	else:
+		x = np.concatenate([c.grids['x'] for c in checkpoints])
+		y = np.concatenate([c.grids['y'] for c in checkpoints])
+		nWindows = first.nWindows
+	return Checkpoint(first.kind, data, first.dt, first.nSamples, first.minFreq, first.maxFreq, x, y, first.grids.get('velocities'), first.grids.get('xvelocities'), first.grids.get('yvelocities'), nWindows, first.oneSided, first.frqRefinement)
+
+
+
+def mergeCheckpointFiles(paths, outPath):
+	'''Merge the checkpoints saved in the directories paths (see mergeCheckpoints) and save the result to the directory outPath, which may be one of paths'''
+	merged = mergeCheckpoints([Checkpoint.load(p) for p in paths])
+	merged.save(outPath)
+	return merged
@@ -0,0 +1,103 @@
+########### Code for splitting sums over receivers or virtual sources across a pool of workers.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+
+
+def chunkedSum(executor, function, rowArrays, otherArgs, outShape, outDtype, nChunks=None, maxWorkers=None):
+	'''executor is a concurrent.futures executor (a ThreadPoolExecutor, or a ProcessPoolExecutor or other executor whose workers run in separate processes). function is a module-level function called as function(*chunkRows, *otherArgs) that returns a numpy array of shape outShape, where chunkRows are the same contiguous rows of every numpy array in rowArrays (the receivers or virtual sources of one chunk). maxWorkers is the number of chunks run at once (int, by default the number of CPUs from os.cpu_count(), so pass the number of workers when the executor has fewer) and the rows are split into nChunks chunks (int, defaults to maxWorkers). This returns the sum of function over all chunks as a numpy array of type outDtype. Each partial sum is added as soon as all chunks before it are, so at most maxWorkers partial sums of outShape are held at once besides the total, on top of the temporary memory of each running chunk (for sigma, one block of phase shifts per worker). The chunks and the order they are summed in do not depend on scheduling, so results are deterministic. Thread workers read rowArrays directly; process workers attach to copies of rowArrays (made once, so they take as much memory again) and write their partial sums into maxWorkers slots of an output array that all live in shared memory, so no arrays are pickled per task.'''
+
+	nRows = rowArrays[0].shape[0]
+	if maxWorkers is None:
+		maxWorkers = os.cpu_count() or 1
+	if nChunks is None:
+		nChunks = maxWorkers
+	nChunks = max(1,min(nChunks,nRows))
+	maxWorkers = max(1,min(maxWorkers,nChunks))
+	bounds = np.linspace(0,nRows,nChunks+1).astype(int)
+	total = np.zeros(outShape,dtype=outDtype)
+
+	# threads share memory with this process already
+	if(isinstance(executor,ThreadPoolExecutor)):
+		def submit(i):
+			return executor.submit(function,*([a[bounds[i]:bounds[i+1]] for a in rowArrays]+list(otherArgs)))
+		for partialSum in _inOrder(submit, nChunks, maxWorkers):
+			total += partialSum
+		return total
+
+	# processes get the inputs and maxWorkers output slots through shared memory
+	sharedBlocks = []
+	try:
+		rowInfos = []
+		for a in rowArrays:
+			shm, info = toSharedMemory(np.ascontiguousarray(a))
+			sharedBlocks.append(shm)
+			rowInfos.append(info)
+		outShm, outInfo = toSharedMemory(np.zeros((maxWorkers,)+tuple(outShape),dtype=outDtype))
+		sharedBlocks.append(outShm)
+		partialSums = np.ndarray(outInfo[1],dtype=np.dtype(outInfo[2]),buffer=outShm.buf)
+		def submit(i):
+			return executor.submit(_sumChunk,function,rowInfos,bounds[i],bounds[i+1],otherArgs,outInfo,i % maxWorkers)
+		for i, _ in enumerate(_inOrder(submit, nChunks, maxWorkers)):
+			total += partialSums[i % maxWorkers]
+		del partialSums
+		return total
+	finally:
+		for shm in sharedBlocks:
+			shm.close()
+			shm.unlink()
+
+
+
+def _inOrder(submit, nChunks, maxWorkers):
+	'''Generate the results of submit(0),...,submit(nChunks-1) in order, keeping at most maxWorkers of them submitted and not yet taken. The next chunk is only submitted once the oldest one has been taken, so chunk i may reuse whatever chunk i-maxWorkers used.'''
+	futures = [submit(i) for i in range(min(maxWorkers,nChunks))]
+	for i in range(nChunks):
+		result = futures[i].result()
+		futures[i] = None
+		yield result
+		result = None
+		if(i+maxWorkers < nChunks):
+			futures.append(submit(i+maxWorkers))
+
+
+
+def toSharedMemory(a):
+	'''Copy the numpy array a into a new shared memory block. This returns the multiprocessing.shared_memory.SharedMemory block (to be closed and unlinked by the caller) and a picklable (name, shape, dtype) description of the array for fromSharedMemory().'''
+	shm = shared_memory.SharedMemory(create=True,size=max(a.nbytes,1))
+	view = np.ndarray(a.shape,dtype=a.dtype,buffer=shm.buf)
+	view[...] = a
+	del view
+	return shm, (shm.name, a.shape, a.dtype.str)
+
+
+
+def fromSharedMemory(info):
+	'''Attach to the shared memory block described by info (from toSharedMemory()). This returns the SharedMemory block (to be closed by the caller once the array is no longer used) and a numpy array viewing it.'''
+	shm = shared_memory.SharedMemory(name=info[0])
+	return shm, np.ndarray(info[1],dtype=np.dtype(info[2]),buffer=shm.buf)
+
+
+
+def _sumChunk(function, rowInfos, start, stop, otherArgs, outInfo, slot):
+	'''Run in a worker process: apply function to rows start:stop of the shared row arrays and write the result into slot of the shared output array'''
+	sharedBlocks = []
+	chunkRows = []
+	a = out = None
+	try:
+		for info in rowInfos:
+			shm, a = fromSharedMemory(info)
+			sharedBlocks.append(shm)
+			chunkRows.append(a[start:stop])
+		outShm, out = fromSharedMemory(outInfo)
+		sharedBlocks.append(outShm)
+		out[slot] = function(*(chunkRows+list(otherArgs)))
+	finally:
+		# views of the shared buffers must be released before the blocks can be closed
+		chunkRows = a = out = None
+		for shm in sharedBlocks:
+			shm.close()
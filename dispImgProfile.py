@@ -0,0 +1,116 @@
+########### Code for timing the stages of the dispersion image pipeline and reporting progress of long runs.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import time
+import threading
+import contextlib
+
+
+# the Profiler collecting measurements, or None when profiling is off (the default)
+active = None
+
+# what stage() hands out when profiling is off, so instrumented code only pays for one check
+noStage = contextlib.nullcontext()
+
+
+
+class Profiler:
+	'''Wall time, call counts, bytes of the arrays produced and estimated floating-point operations of each named stage of the pipeline (such as 'trace.set_bandSpec', 'filterFunction', 'spectrum slicing', 'phase shifts', 'sigma accumulation' and 'virtual sources'), plus an optional progress callback. Stages may be nested, in which case the time of the inner stage is also counted in the outer one. Stages running in threads are recorded, while those in worker processes of a process pool are not.'''
+
+
+	def __init__(self, callback=None):
+		'''callback is an optional function called as callback(name, done, total, metrics) as long runs progress, where name names the loop (for example 'sigma2D' over receivers or 'stream2D' over time windows), done is how many of total items are finished (total is None when unknown) and metrics is a dict of extra values such as the elapsed seconds'''
+		self.callback = callback
+		self.stats = {} # stage name -> {'calls', 'seconds', 'bytes', 'flops'}
+		self.startTime = time.perf_counter()
+		self.lock = threading.Lock()
+
+	def stage(self, name, nBytes=0, flops=0):
+		'''Get a context manager that times one call of the stage name, which produces about nBytes bytes of arrays and does about flops floating-point operations'''
+		return stageTimer(self, name, nBytes, flops)
+
+	def record(self, name, seconds, nBytes=0, flops=0):
+		'''Add one call of the stage name taking seconds of wall time to the totals'''
+		with self.lock:
+			if name not in self.stats:
+				self.stats[name] = {'calls':0, 'seconds':0.0, 'bytes':0, 'flops':0}
+			entry = self.stats[name]
+			entry['calls'] += 1
+			entry['seconds'] += seconds
+			entry['bytes'] += int(nBytes)
+			entry['flops'] += int(flops)
+
+	def progress(self, name, done, total=None, **metrics):
+		'''Pass the progress of the loop name (done of total items) and any extra metrics to the callback, adding the seconds elapsed since profiling started'''
+		if self.callback is not None:
+			metrics['elapsed'] = time.perf_counter()-self.startTime
+			self.callback(name, done, total, metrics)
+
+
+	def summary(self):
+		'''Get a dict with the seconds elapsed since profiling started and a list of the stages, each a dict with its name, calls, seconds, bytes, flops and flop rate (flops per second), slowest stage first'''
+		with self.lock:
+			stages = [dict(entry, name=name) for name, entry in self.stats.items()]
+		for entry in stages:
+			entry['flopRate'] = entry['flops']/entry['seconds'] if entry['seconds'] > 0 else 0.0
+		stages.sort(key=lambda entry: -entry['seconds'])
+		return {'elapsed':time.perf_counter()-self.startTime, 'stages':stages}
+
+	def report(self):
+		'''Get the summary as a table (str) with one line per stage'''
+		summary = self.summary()
+		lines = ['%-24s %8s %10s %6s %12s %10s' % ('stage','calls','seconds','%','MB','GFLOP/s')]
+		for entry in summary['stages']:
+			share = 100*entry['seconds']/summary['elapsed'] if summary['elapsed'] > 0 else 0.0
+			lines.append('%-24s %8d %10.4f %6.1f %12.1f %10.2f' % (entry['name'], entry['calls'], entry['seconds'], share, entry['bytes']/2**20, entry['flopRate']/1e9))
+		lines.append('%-24s %8s %10.4f' % ('elapsed','',summary['elapsed']))
+		return '\n'.join(lines)
+
+
+
+class stageTimer:
+	'''Context manager recording one call of a stage in a Profiler'''
+
+	def __init__(self, profiler, name, nBytes, flops):
+		self.profiler = profiler
+		self.name = name
+		self.nBytes = nBytes
+		self.flops = flops
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.profiler.record(self.name, time.perf_counter()-self.start, self.nBytes, self.flops)
+		return False
+
+
+
+def stage(name, nBytes=0, flops=0):
+	'''Get a context manager timing one call of the stage name in the active Profiler (see Profiler.stage), or one that does nothing when profiling is off'''
+	if active is None:
+		return noStage
+	return active.stage(name, nBytes, flops)
+
+def progress(name, done, total=None, **metrics):
+	'''Report the progress of the loop name to the active Profiler (see Profiler.progress), if profiling is on'''
+	if active is not None:
+		active.progress(name, done, total, **metrics)
+
+
+
+@contextlib.contextmanager
+def profiling(callback=None):
+	'''Turn profiling on for the duration of a with block and give the Profiler collecting it (callback is as in Profiler), for example
+		with dispImgProfile.profiling() as profiler:
+			fastDispImg2D.dispImgStack2D(...)
+		print(profiler.report())
+	The previously active Profiler, if any, is restored afterwards.'''
+	global active
+	previous = active
+	active = Profiler(callback)
+	try:
+		yield active
+	finally:
+		active = previous
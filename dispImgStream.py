@@ -0,0 +1,144 @@
+########### Code for stacking dispersion images over many time windows of long continuous records.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import numpy as np
+import traceClass as tr
+import fastDispImg2D as fdi2
+import fastDispImg3D as fdi3
+import dispImgCheckpoint as dck
+import dispImgProfile as dpf
+
+
+
+def slidingWindows(data, windowLength, overlap=0):
+	'''data is a 2D numpy array (or numpy memmap, see traceClass.TraceGather.fromFile) nRec x nTotal of continuous records, windowLength is the number of samples in each window (int) and overlap is the number of samples shared by consecutive windows (int, smaller than windowLength). This generates an nRec x windowLength view of data for each complete window, so a memory-mapped record is only read from disk one window at a time.'''
+
+	step = windowLength-overlap
+	if(step < 1):
+		raise ValueError("overlap must be smaller than windowLength")
+	for start in range(0,data.shape[1]-windowLength+1,step):
+		yield data[:,start:start+windowLength]
+
+
+
+def streamDispImgStack2D(windows, dt, x, velocities, minFreq, maxFreq, filterFunction, yieldEvery=None, memoryBudget=None, dtype=complex, checkpointPath=None, checkpointEvery=None):
+	'''windows is an iterable of 2D numpy arrays nRec x nSamples of real data (for example from slidingWindows()), each holding one time window recorded by the same receivers with the same length. dt is the time (s) between samples, x is a 1D numpy array of the nRec receiver positions (m), velocities are a 1D numpy array of velocities of interest (m/s) and minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that is called once per window on a traceClass.TraceGather holding that window. memoryBudget is the number of bytes the phase shifts of the receivers may take (int, defaults to fastDispImg2D.defaultBlockBytes): if all of them fit they are computed once and reused for every window, otherwise they are recomputed in blocks of this size. dtype is the complex type the spectra, phase shifts and sigma are computed in (complex, or np.complex64 for half the memory and about single precision accuracy). This generates a tuple (nWindows, dispImgStack) every yieldEvery windows (int, by default only after the last window), where dispImgStack is a copy of the nVel x nFrq dispersion image stacked over all virtual sources and the first nWindows windows. If checkpointPath is given, the stack is saved there as a dispImgCheckpoint.Checkpoint every checkpointEvery windows (int, by default only after the last window), and a checkpoint already saved there by the same setup is resumed from: the windows it covers are skipped and its stack is added to.'''
+
+	x = np.asarray(x,dtype=float)
+	if memoryBudget is None:
+		memoryBudget = fdi2.defaultBlockBytes
+
+	dispImgStack = None
+	nWindows = 0
+	for window in windows:
+		gather = tr.TraceGather(window, dt, x, dtype=dtype)
+
+		# the band and the phase shifts only depend on the geometry and window length, so set them up once
+		if dispImgStack is None:
+			minFrqIdx = gather.getIdxFromHz(minFreq)
+			maxFrqIdx = gather.getIdxFromHz(maxFreq)
+			posFrqs = gather.getPosFrqs(minFrqIdx,maxFrqIdx)
+			blockSize = fdi2.receiverBlockSize(fdi2.receiverBytes2D(velocities.size, posFrqs.size, dtype), memoryBudget)
+			phaseShiftBlocks = None
+			if(x.size <= blockSize):
+				phaseShiftBlocks = list(fdi2.phaseShiftBlocks2D(x, velocities, posFrqs, blockSize, dtype))
+			dispImgStack = np.zeros((velocities.size,posFrqs.size))
+			checkpoint = dck.Checkpoint('stack', None, dt, gather.nSamples, minFreq, maxFreq, x, velocities=velocities, nWindows=0)
+			nResumed = resume(checkpoint, checkpointPath, dispImgStack)
+			nWindows = nResumed
+			nSkipped = 0
+
+		# windows already in the resumed checkpoint are skipped
+		if(nSkipped < nResumed):
+			nSkipped += 1
+			continue
+
+		# the windows are real, so only the positive band is needed
+		filterFunction(gather) # call user-defined filters
+		posSpecs = gather.getPosSpecs(minFrqIdx,maxFrqIdx)
+		sigma = fdi2.sigma2DFromSpecs(posSpecs, x, velocities, posFrqs, blockSize, phaseShiftBlocks)
+		dispImgStack += fdi2.dispImgStack2DFromAmplitudes(tr.sumAmplitudeSpectra(posSpecs), sigma, oneSided=True)
+		nWindows += 1
+		dpf.progress('stream2D', nWindows)
+
+		if(checkpointPath is not None and checkpointEvery is not None and nWindows % checkpointEvery == 0):
+			saveStack(checkpoint, checkpointPath, dispImgStack, nWindows)
+		if(yieldEvery is not None and nWindows % yieldEvery == 0):
+			yield nWindows, dispImgStack.copy()
+
+	if(dispImgStack is not None and checkpointPath is not None and (checkpointEvery is None or nWindows % checkpointEvery != 0)):
+		saveStack(checkpoint, checkpointPath, dispImgStack, nWindows)
+	if(dispImgStack is not None and (yieldEvery is None or nWindows % yieldEvery != 0)):
+		yield nWindows, dispImgStack.copy()
+
+
+
+def streamDispImgStack3D(windows, dt, x, y, xvelocities, yvelocities, minFreq, maxFreq, filterFunction, yieldEvery=None, memoryBudget=None, dtype=complex, checkpointPath=None, checkpointEvery=None):
+	'''windows is an iterable of 2D numpy arrays nRec x nSamples of real data (for example from slidingWindows()), each holding one time window recorded by the same receivers with the same length. dt is the time (s) between samples, x and y are 1D numpy arrays of the nRec receiver positions (m), xvelocities and yvelocities are 1D numpy arrays of velocities of interest (m/s) and minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that is called once per window on a traceClass.TraceGather holding that window. memoryBudget is the number of bytes the x and y phase shifts of the receivers may take (int, defaults to fastDispImg3D.defaultBlockBytes): if all of them fit they are computed once and reused for every window, otherwise they are recomputed in blocks of this size. dtype is the complex type the spectra, phase shifts and sigma are computed in (complex, or np.complex64 for half the memory and about single precision accuracy). This generates a tuple (nWindows, dispImgStack) every yieldEvery windows (int, by default only after the last window), where dispImgStack is a copy of the nxVel x nyVel x nFrq dispersion image stacked over all virtual sources and the first nWindows windows. If checkpointPath is given, the stack is saved there as a dispImgCheckpoint.Checkpoint every checkpointEvery windows (int, by default only after the last window), and a checkpoint already saved there by the same setup is resumed from: the windows it covers are skipped and its stack is added to.'''
+
+	x = np.asarray(x,dtype=float)
+	y = np.asarray(y,dtype=float)
+	if memoryBudget is None:
+		memoryBudget = fdi3.defaultBlockBytes
+
+	dispImgStack = None
+	nWindows = 0
+	for window in windows:
+		gather = tr.TraceGather(window, dt, x, y, dtype)
+
+		# the band and the phase shifts only depend on the geometry and window length, so set them up once
+		if dispImgStack is None:
+			minFrqIdx = gather.getIdxFromHz(minFreq)
+			maxFrqIdx = gather.getIdxFromHz(maxFreq)
+			posFrqs = gather.getPosFrqs(minFrqIdx,maxFrqIdx)
+			blockSize = fdi2.receiverBlockSize(fdi3.receiverBytes3D(xvelocities.size, yvelocities.size, posFrqs.size, dtype), memoryBudget)
+			phaseShiftBlocks = None
+			if(x.size <= blockSize):
+				phaseShiftBlocks = list(fdi3.phaseShiftBlocks3D(x, y, xvelocities, yvelocities, posFrqs, blockSize, dtype))
+			dispImgStack = np.zeros((xvelocities.size,yvelocities.size,posFrqs.size))
+			checkpoint = dck.Checkpoint('stack', None, dt, gather.nSamples, minFreq, maxFreq, x, y, xvelocities=xvelocities, yvelocities=yvelocities, nWindows=0)
+			nResumed = resume(checkpoint, checkpointPath, dispImgStack)
+			nWindows = nResumed
+			nSkipped = 0
+
+		# windows already in the resumed checkpoint are skipped
+		if(nSkipped < nResumed):
+			nSkipped += 1
+			continue
+
+		# the windows are real, so only the positive band is needed
+		filterFunction(gather) # call user-defined filters
+		posSpecs = gather.getPosSpecs(minFrqIdx,maxFrqIdx)
+		sigma = fdi3.sigma3DFromSpecs(posSpecs, x, y, xvelocities, yvelocities, posFrqs, blockSize, phaseShiftBlocks)
+		dispImgStack += fdi3.dispImgStack3DFromAmplitudes(tr.sumAmplitudeSpectra(posSpecs), sigma, oneSided=True)
+		nWindows += 1
+		dpf.progress('stream3D', nWindows)
+
+		if(checkpointPath is not None and checkpointEvery is not None and nWindows % checkpointEvery == 0):
+			saveStack(checkpoint, checkpointPath, dispImgStack, nWindows)
+		if(yieldEvery is not None and nWindows % yieldEvery == 0):
+			yield nWindows, dispImgStack.copy()
+
+	if(dispImgStack is not None and checkpointPath is not None and (checkpointEvery is None or nWindows % checkpointEvery != 0)):
+		saveStack(checkpoint, checkpointPath, dispImgStack, nWindows)
+	if(dispImgStack is not None and (yieldEvery is None or nWindows % yieldEvery != 0)):
+		yield nWindows, dispImgStack.copy()
+
+
+
+def resume(checkpoint, checkpointPath, dispImgStack):
+	'''If a checkpoint was saved at checkpointPath (including one left by a save interrupted by a crash, see dispImgCheckpoint.findCheckpoint), check that its setup matches the dispImgCheckpoint.Checkpoint checkpoint (raising a ValueError if not), add its stack into dispImgStack and return the number of windows it covers (0 if there is none)'''
+	if(checkpointPath is None or dck.findCheckpoint(checkpointPath) is None):
+		return 0
+	saved = dck.Checkpoint.load(checkpointPath)
+	saved.checkCompatible(checkpoint)
+	dispImgStack += saved.data
+	return saved.nWindows
+
+
+
+def saveStack(checkpoint, checkpointPath, dispImgStack, nWindows):
+	'''Save dispImgStack, stacked over nWindows windows, to checkpointPath with the setup of the dispImgCheckpoint.Checkpoint checkpoint'''
+	checkpoint.data = dispImgStack
+	checkpoint.nWindows = nWindows
+	checkpoint.save(checkpointPath)
@@ -6,94 +6,303 @@ import math
 import numpy as np
 import scipy.fftpack as ft
 import traceClass as tr
+import dispImgParallel as dip
+import dispImgCache as dic
+import dispImgProfile as dpf
 
 
+# default memory (bytes) used by the phase shifts of one block of receivers
+defaultBlockBytes = 2**26
 
-def sigma2D(traces, velocities, minFreq, maxFreq, filterFunction):
-	'''traces is a list of trace objects (defined in traceClass.py) assumed to all have the same length traces with the same sampling rate. velocities are a 1D numpy array of velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it. This calculates the common factor (sigma) in all dispersion images that use these traces as receivers, which is returned as a 2D numpy array nVel x 2*nFrq where nFrq is the number of frequency bins between minFreq and maxFreq. This will return results in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq,-maxFreq,...,-minFreq'''
 
-	# define dimensions of sigma
-	nVel = velocities.size
-	minFrqIdx = traces[0].getIdxFromHz(minFreq)
-	maxFrqIdx = traces[0].getIdxFromHz(maxFreq)
-	nFrq = maxFrqIdx-minFrqIdx
-	# initialize the common factor to all dispersion images
-	sigma = np.zeros((nVel,2*nFrq))
 
-	# calculate the frequencies of interest
-	actualMinFrq = minFrqIdx*traces[0].getNHzPerBin()
-	actualMaxFrq = maxFrqIdx*traces[0].getNHzPerBin()
-	posNegFrqs = np.hstack((np.linspace(actualMinFrq,actualMaxFrq,nFrq),-1*np.flipud(np.linspace(actualMinFrq,actualMaxFrq,nFrq))))
+def sigma2D(traces, velocities, minFreq, maxFreq, filterFunction, blockSize=None, oneSided=False, executor=None, cache=None, nChunks=None, maxWorkers=None):
+	'''traces is a list of trace objects (defined in traceClass.py) assumed to all have the same length traces with the same sampling rate, or a traceClass.TraceGather holding all of them in one array. velocities are a 1D numpy array of velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it (a TraceGather is passed to it whole). blockSize is the number of receivers whose phase shifts are formed at once (int, by default chosen so the phase shifts of a block take about defaultBlockBytes of memory). This calculates the common factor (sigma) in all dispersion images that use these traces as receivers, which is returned as a 2D numpy array nVel x 2*nFrq (of the complex type of the trace spectra) where nFrq is the number of frequency bins between minFreq and maxFreq. This will return results in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq,-maxFreq,...,-minFreq. If oneSided is True the traces are assumed to be real-valued, and only the positive band minFreq,...,maxFreq of sigma is computed and returned as an nVel x nFrq array (the negative band is its conjugate, see traceClass.posNegFromPos). executor is an optional concurrent.futures thread or process pool over which the receivers are split into nChunks chunks, maxWorkers of them at once (see dispImgParallel.chunkedSum, both default to the number of CPUs); the result matches the serial one to floating-point rounding. Each running chunk holds its own sigma and block of phase shifts, so the peak memory grows by about maxWorkers times their size (and a process pool also gets a shared copy of the band-limited spectra). cache is an optional dispImgCache.PhaseShiftCache to keep the phase shifts of sigma in between calls with the same geometry; without one they are formed block by block and dropped, so memory stays within the block budget (workers of an executor never keep them).'''
+
+	# stack the filtered spectra of all receivers limited to frequencies of interest (nRec x 2*nFrq, or nRec x nFrq if oneSided)
+	subsetSpecs, x, y, posNegFrqs = tr.bandSpectra(traces, minFreq, maxFreq, filterFunction, oneSided)
+
+	if executor is None:
+		return sigma2DFromSpecs(subsetSpecs, x, velocities, posNegFrqs, blockSize, cache=cache)
+	return dip.chunkedSum(executor, sigma2DFromSpecs, (subsetSpecs, x), (velocities, posNegFrqs, blockSize), (velocities.size, posNegFrqs.size), subsetSpecs.dtype, nChunks, maxWorkers)
 
-	# define the phase shift matrix
-	p = 1.0/velocities # slowness vector
-	phaseShiftMat = np.exp(2*np.pi*1j*np.outer(p,posNegFrqs))
 
-	# for each trace, apply a phase shift to 
-	for r in traces:
 
-		filterFunction(r) # call user-defined filters
+def sigma2DFromSpecs(subsetSpecs, x, velocities, posNegFrqs, blockSize=None, phaseShiftBlocks=None, cache=None):
+	'''subsetSpecs is a 2D numpy array nRec x 2*nFrq of already filtered band-limited receiver spectra (as returned by traceClass.bandSpectra), x is a 1D numpy array of the nRec receiver positions (m), velocities are a 1D numpy array of velocities of interest (m/s) and posNegFrqs are the 2*nFrq frequencies (Hz) of the columns of subsetSpecs (or the nFrq positive ones for one-sided spectra). blockSize is the number of receivers whose phase shifts are formed at once. phaseShiftBlocks is an optional list of the blocks returned by phaseShiftBlocks2D() for this geometry. Otherwise they are formed one block at a time, unless a cache (a dispImgCache.PhaseShiftCache) is given: then all blocks are formed at once and kept in it whenever they fit, so repeated calls for the same geometry, band and velocities reuse them at the cost of holding them in memory. This returns sigma as a 2D numpy array nVel x posNegFrqs.size (of the complex type of subsetSpecs) by summing exp(2*pi*i*p*f*x)*spectrum over receivers as one batched matrix product per block of receivers.'''
 
-		# just get the spectrum limited to frequencies of interest
-		if(minFrqIdx <= 1):
-			subsetSpec = np.hstack((r.dataSpec[minFrqIdx:maxFrqIdx],r.dataSpec[1-maxFrqIdx:]))
+	if phaseShiftBlocks is None:
+		if blockSize is None:
+			blockSize = receiverBlockSize(receiverBytes2D(velocities.size, posNegFrqs.size, subsetSpecs.dtype), defaultBlockBytes)
+		if cache is None:
+			phaseShiftBlocks = phaseShiftBlocks2D(x, velocities, posNegFrqs, blockSize, subsetSpecs.dtype)
 		else:
-			subsetSpec = np.hstack((r.dataSpec[minFrqIdx:maxFrqIdx],r.dataSpec[1-maxFrqIdx:1-minFrqIdx])) 
+			key = ('phaseShiftBlocks2D', dic.arrayKey(x), dic.arrayKey(velocities), dic.arrayKey(posNegFrqs), blockSize, subsetSpecs.dtype.str)
+			nBytes = x.size*velocities.size*posNegFrqs.size*subsetSpecs.itemsize
+			phaseShiftBlocks = cache.getBlocks(key, nBytes, lambda: phaseShiftBlocks2D(x, velocities, posNegFrqs, blockSize, subsetSpecs.dtype))
+
+	# sigma is accumulated frequency-major so each block is a stack of (nVel x nBlock) x (nBlock) products
+	sigma = np.zeros((posNegFrqs.size,velocities.size),dtype=subsetSpecs.dtype)
+	for start, stop, phaseShifts in phaseShiftBlocks:
+		with dpf.stage('sigma accumulation', 0, 8*phaseShifts.size):
+			sigma += np.matmul(phaseShifts,subsetSpecs[start:stop,:].T[:,:,np.newaxis])[:,:,0]
+		dpf.progress('sigma2D', stop, subsetSpecs.shape[0])
+		phaseShifts = None # let go of this block before the next one is formed
+
+	# return an nVel x 2*nFrq array
+	return np.ascontiguousarray(sigma.T)
+
+
+
+def phaseShiftBlocks2D(x, velocities, posNegFrqs, blockSize=None, dtype=complex):
+	'''x is a 1D numpy array of the nRec receiver positions (m), velocities are a 1D numpy array of velocities of interest (m/s) and posNegFrqs are the frequencies (Hz) of interest. blockSize is the number of receivers per block (int, by default chosen so each block takes about defaultBlockBytes of memory while it is formed, see receiverBytes2D). This generates a tuple (start, stop, phaseShifts) for each block of receivers x[start:stop], where phaseShifts is the 3D numpy array 2*nFrq x nVel x nBlock of exp(2*pi*i*p*f*x) of the complex type dtype. A block is only referenced here until the next one is formed.'''
+
+	nRec = x.size
+	if blockSize is None:
+		blockSize = receiverBlockSize(receiverBytes2D(velocities.size, posNegFrqs.size, dtype), defaultBlockBytes)
+
+	# phase shift (radians) per meter of receiver position for each frequency and slowness
+	p = 1.0/velocities # slowness vector
+	phasePerMeter = 2*np.pi*np.outer(posNegFrqs,p) # 2*nFrq x nVel
+
+	for start in range(0,nRec,blockSize):
+		stop = min(start+blockSize,nRec)
+		nShifts = posNegFrqs.size*velocities.size*(stop-start)
+		with dpf.stage('phase shifts', nShifts*np.dtype(dtype).itemsize, 20*nShifts):
+			phaseShifts = expi(np.multiply.outer(phasePerMeter,x[start:stop]), dtype)
+		yield start, stop, phaseShifts
+		phaseShifts = None
+
+
+
+def receiverBlockSize(receiverBytes, blockBytes):
+	'''Get the number of receivers (int, at least 1) that fit in about blockBytes bytes of memory when each takes receiverBytes bytes (from receiverBytes2D or fastDispImg3D.receiverBytes3D)'''
+	return max(1,int(blockBytes//receiverBytes))
+
+
+
+def receiverBytes2D(nVel, nCols, dtype=complex):
+	'''Get the bytes (int) held per receiver of a block of phaseShiftBlocks2D() with nVel velocities and nCols frequencies of the complex type dtype while it is formed: each phase shift and its double precision angle'''
+	return nVel*nCols*(np.dtype(dtype).itemsize+8)
+
+
+
+def expi(angles, dtype=complex):
+	'''Get exp(i*angles) for a numpy array of angles (radians, double precision) as a numpy array of the complex type dtype. The cosine and sine are taken in double precision straight into the real and imaginary parts of the result, so phases of many cycles keep their accuracy in single precision and no temporary beyond the result is made.'''
+	out = np.empty(np.shape(angles),dtype=dtype)
+	np.cos(angles,out=out.real)
+	np.sin(angles,out=out.imag)
+	return out
+
+
+
+def receiverPhaseShifts(position, velocities, frqs, sign=1, dtype=complex, cache=None):
+	'''position is the coordinate (m) of one receiver along one axis, velocities are a 1D numpy array of velocities of interest (m/s) along that axis and frqs are the frequencies (Hz) of interest. This returns the 2D numpy array nVel x frqs.size of exp(sign*2*pi*i*p*f*position) of the complex type dtype (sign=-1 for a virtual source), kept in cache (a dispImgCache.PhaseShiftCache, defaults to dispImgCache.defaultCache) under the receiver position, velocities and frequencies so it is only formed once. The returned array is shared and must not be modified.'''
+	if cache is None:
+		cache = dic.defaultCache
+	key = ('receiverPhaseShifts', float(position), dic.arrayKey(velocities), dic.arrayKey(frqs), sign, np.dtype(dtype).str)
+	return cache.get(key, lambda: expi(sign*2*np.pi*position*np.outer(1.0/velocities,frqs), dtype))
+
+
+
+def planSigma2D(nRec, nSamples, dt, velocities, minFreq, maxFreq, dtype=complex, oneSided=False, memoryLimit=None, blockBytes=None, frqRefinement=1):
+	'''Estimate the cost of sigma2D() for nRec receivers recording nSamples samples spaced dt (s) apart, before any data are read. velocities, minFreq, maxFreq and oneSided are as in sigma2D(), dtype and frqRefinement are the complex type (complex, or np.complex64 to halve the memory) and the frequency refinement of the trace spectra (see traceClass.TraceGather) and blockBytes is the most memory for one block of receivers while its phase shifts are formed (bytes, defaults to defaultBlockBytes, see receiverBytes2D). This returns a dict (see sigmaPlan()) with the largest block of receivers that keeps the estimated peak memory under memoryLimit bytes, and whose entry 'fits' tells whether any block does.'''
+
+	# frequency bins of the band, as in traceClass.bandSpectra
+	grid = tr.frequencyGrid()
+	grid.dt = dt
+	grid.nSamples = nSamples
+	grid.frqRefinement = frqRefinement
+	nFrq = grid.getIdxFromHz(maxFreq)-grid.getIdxFromHz(minFreq)
+	nCols = nFrq if oneSided else 2*nFrq
+	return sigmaPlan(nRec, nFrq, nCols, velocities.size, velocities.size, receiverBytes2D(velocities.size, nCols, dtype), dtype, memoryLimit, blockBytes)
+
+
+
+def sigmaPlan(nRec, nFrq, nCols, nOut, nPerColumn, receiverBytes, dtype=complex, memoryLimit=None, blockBytes=None):
+	'''Estimate the memory and work of sigma for nRec receivers, nFrq frequency bins stored in nCols columns, nOut values of sigma per column, nPerColumn phase shifts per receiver and column and receiverBytes bytes held per receiver of a block (from receiverBytes2D or fastDispImg3D.receiverBytes3D). The receivers are taken in blocks that take at most blockBytes bytes (defaults to defaultBlockBytes), made smaller if needed so the estimated peak memory stays under memoryLimit (bytes, no limit if None). This returns a dict with nFrq, nCols, the bytes itemBytes per complex value, the bytes spectraBytes of the band-limited spectra and sigmaBytes of sigma, the number of receivers blockSize per block and the bytes blockBytes a block takes (to pass as memoryBudget to the stacks), the estimated peakBytes held at once, the number of floating-point operations flops and fits (False if even blocks of one receiver exceed memoryLimit).'''
+
+	if blockBytes is None:
+		blockBytes = defaultBlockBytes
+	itemBytes = np.dtype(dtype).itemsize
+	blockSize = min(nRec,receiverBlockSize(receiverBytes, blockBytes))
+	spectraBytes = nRec*nCols*itemBytes
+	sigmaBytes = nOut*nCols*itemBytes
+	# sigma is accumulated in one array and reordered (2D) or updated through a temporary (3D) of the same size, and the phase per meter of every column and slowness is kept in double precision
+	fixedBytes = spectraBytes+2*sigmaBytes+8*nPerColumn*nCols
+	fits = True
+	if memoryLimit is not None:
+		# largest block whose phase shifts still fit next to the spectra and sigma
+		blockSize = min(blockSize,int((memoryLimit-fixedBytes)//receiverBytes))
+		fits = blockSize >= 1
+		blockSize = max(1,blockSize)
+	peakBytes = fixedBytes+blockSize*receiverBytes
+	# a complex multiply-add (8 flops) per receiver and value of sigma, plus about 20 flops to form each phase shift
+	flops = 8*nRec*nOut*nCols+20*nRec*nPerColumn*nCols
+	return {'nFrq':nFrq, 'nCols':nCols, 'itemBytes':itemBytes, 'spectraBytes':spectraBytes, 'sigmaBytes':sigmaBytes, 'blockSize':blockSize, 'blockBytes':blockSize*receiverBytes, 'peakBytes':peakBytes, 'flops':flops, 'fits':fits}
+
 
-		# add phase shifted subset of fourier transform of filtered data to sigma
-		sigma = sigma + np.tile(subsetSpec,(nVel,1))*np.power(phaseShiftMat,r.x)
+
+def sigma2DRegular(traces, velocities, minFreq, maxFreq, filterFunction, dx=None, oneSided=False, spreadWidth=12):
+	'''Same as sigma2D() for receivers on a regularly spaced line (for example DAS channels or a geophone line, missing receivers are allowed). dx is the receiver spacing (m), by default the smallest distance between receivers. Because the positions are x0+m*dx, the sum over receivers at each frequency f is a spatial Fourier series evaluated at the wavenumbers f/velocities, which is computed with a non-uniform FFT (see slantSum) in roughly O(nFrq*(nRec*log(nRec)+nVel*spreadWidth)) operations instead of O(nFrq*nRec*nVel). spreadWidth (int) sets the accuracy: 12 gives about 1e-11 relative error, 16 about 1e-13. This returns sigma as a 2D numpy array nVel x 2*nFrq (nVel x nFrq if oneSided) like sigma2D().'''
+
+	# stack the filtered spectra of all receivers limited to frequencies of interest (nRec x 2*nFrq, or nRec x nFrq if oneSided)
+	subsetSpecs, x, y, posNegFrqs = tr.bandSpectra(traces, minFreq, maxFreq, filterFunction, oneSided)
+
+	return sigma2DRegularFromSpecs(subsetSpecs, x, velocities, posNegFrqs, dx, spreadWidth)
+
+
+
+def sigma2DRegularFromSpecs(subsetSpecs, x, velocities, posNegFrqs, dx=None, spreadWidth=12):
+	'''subsetSpecs is a 2D numpy array nRec x 2*nFrq of already filtered band-limited receiver spectra (as returned by traceClass.bandSpectra), x is a 1D numpy array of the nRec receiver positions (m) on a regular grid with spacing dx (m, by default detected by regularPositions), velocities are a 1D numpy array of velocities of interest (m/s) and posNegFrqs are the frequencies (Hz) of the columns of subsetSpecs. This returns sigma as a 2D numpy array nVel x posNegFrqs.size, computed by slantSum().'''
+
+	# place the spectra on the regular grid of receiver positions x0+m*dx (frequency-major)
+	x0, dx, m = regularPositions(x, dx)
+	gridSpecs = np.zeros((posNegFrqs.size,m.max()+1),dtype=subsetSpecs.dtype)
+	np.add.at(gridSpecs.T,m,subsetSpecs)
+
+	# sum over the grid at wavenumber f*p, then shift the phases by the grid origin
+	p = 1.0/velocities # slowness vector
+	with dpf.stage('slant stack', gridSpecs.shape[0]*p.size*subsetSpecs.itemsize, slantSumFlops(gridSpecs.shape, p.size, spreadWidth)):
+		sigma = slantSum(gridSpecs, dx*np.outer(posNegFrqs,p), spreadWidth) # 2*nFrq x nVel
+	sigma *= expi(2*np.pi*x0*np.outer(posNegFrqs,p), sigma.dtype)
 
 	# return an nVel x 2*nFrq array
-	return sigma
+	return np.ascontiguousarray(sigma.T)
+
+
+
+def regularPositions(x, dx=None, tolerance=1e-6):
+	'''x is a 1D numpy array of receiver positions (m) and dx is the grid spacing (m, by default the smallest distance between distinct positions). This returns a tuple (x0, dx, m) where x0 is the smallest position and m is a 1D numpy array of ints such that x = x0+m*dx to within tolerance*dx, or raises a ValueError if the positions are not on such a grid.'''
+	x = np.asarray(x,dtype=float)
+	x0 = np.min(x)
+	if dx is None:
+		steps = np.diff(np.unique(x))
+		dx = np.min(steps) if steps.size > 0 else 1.0
+	m = np.round((x-x0)/dx).astype(int)
+	if(np.max(np.absolute(x-x0-m*dx)) > tolerance*dx):
+		raise ValueError("receiver positions are not on a regular grid with spacing "+str(dx)+" m")
+	return x0, dx, m
+
+
+
+def slantSumFlops(shape, nOut, spreadWidth=12):
+	'''Get an estimate of the floating-point operations of slantSum() on gridValues of the given shape with nOut outputs per row'''
+	nRows = int(np.prod(shape[:-1]))
+	return nRows*(tr.fftFlops(2*shape[-1])+16*spreadWidth*nOut)
+
+
 
+def slantSum(gridValues, cycles, spreadWidth=12):
+	'''gridValues is a numpy array nFrq x ... x nGrid of values on a regular grid of receivers and cycles is a 2D numpy array nFrq x nOut of phase increments per grid step (cycles, for example dx*f*p). This returns the numpy array nFrq x ... x nOut of sum_n gridValues[...,n]*exp(2*pi*i*n*cycles) over the last axis, for each frequency separately. It is a type-2 non-uniform FFT with a Gaussian kernel (Greengard and Lee, 2004): the grid values are deconvolved by the kernel, transformed by one FFT of twice the grid length, and the result at each requested point is the kernel-weighted sum of its 2*spreadWidth nearest FFT samples.'''
 
+	nGrid = gridValues.shape[-1]
+	nHalf = nGrid//2 # grid indices are centered on nHalf to keep the deconvolution small
+	nFFT = 2*nGrid
+	tau = np.pi*spreadWidth/(nGrid*nGrid*2*1.5) # Gaussian kernel width for twofold oversampling
 
-def dispImg2D(aFilteredTrace, velocities, minFreq, maxFreq, sigma):
-	'''aFilteredTrace is a trace object (defined in traceClass.py) assumed to have already been filtered that will act as a virtual source for this dispersion image. minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). velocities are a 1D numpy array of velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). sigma is the common factor in all dispersion images that use these traces as receivers, which is returned by sigma2D() as a 2D numpy array nVel x 2*nFrq where nFrq is the number of frequency bins between minFreq and maxFreq. The sigma matrix will be in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq,-maxFreq,...,-minFreq. This function will return a dispersion image in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq. It will have been symmetrized for positive and negative frequencies, and all returned values will be non-negative.'''
+	# deconvolve by the kernel and sample the result on nFFT points per period
+	k = np.arange(nGrid)-nHalf
+	realType = np.finfo(gridValues.dtype).dtype
+	oversampled = np.zeros(gridValues.shape[:-1]+(nFFT,),dtype=gridValues.dtype)
+	oversampled[...,k % nFFT] = gridValues*np.exp(k*k*tau).astype(realType)
+	oversampled = nFFT*np.fft.ifft(oversampled,axis=-1)
+
+	# spread the kernel around each requested point (one angle per frequency and output)
+	angles = 2*np.pi*(cycles % 1.0)
+	angles = angles.reshape(angles.shape[:1]+(1,)*(gridValues.ndim-2)+angles.shape[1:])
+	outShape = gridValues.shape[:-1]+(cycles.shape[1],)
+	nearest = np.round(angles*nFFT/(2*np.pi)).astype(int)
+	out = np.zeros(outShape,dtype=gridValues.dtype)
+	for shift in range(1-spreadWidth,spreadWidth+1):
+		idx = nearest+shift
+		weights = np.exp(-(angles-2*np.pi*idx/nFFT)**2/(4*tau)).astype(realType)
+		out += weights*np.take_along_axis(oversampled,np.broadcast_to(idx % nFFT,outShape),axis=-1)
+
+	# undo the kernel normalization and the centering of the grid indices
+	out *= np.sqrt(np.pi/tau)/nFFT
+	out *= expi(nHalf*angles, out.dtype)
+	return out
+
+
+
+def dispImg2D(aFilteredTrace, velocities, minFreq, maxFreq, sigma, cache=None):
+	'''aFilteredTrace is a trace object (defined in traceClass.py) assumed to have already been filtered that will act as a virtual source for this dispersion image. minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). velocities are a 1D numpy array of velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). sigma is the common factor in all dispersion images that use these traces as receivers, which is returned by sigma2D() as a 2D numpy array nVel x 2*nFrq (or nVel x nFrq if it was computed oneSided) where nFrq is the number of frequency bins between minFreq and maxFreq. The sigma matrix will be in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq,-maxFreq,...,-minFreq. This function will return a dispersion image in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq. It will have been symmetrized for positive and negative frequencies, and all returned values will be non-negative. The frequency grid and the phase shifts of the virtual source are kept in cache (a dispImgCache.PhaseShiftCache, defaults to dispImgCache.defaultCache), so imaging many windows with the same virtual sources only forms them once.'''
+
+	if cache is None:
+		cache = dic.defaultCache
 
 	# define dimensions of spectrum of interest
-	minFrqIdx = aFilteredTrace.getIdxFromHz(minFreq)
-	maxFrqIdx = aFilteredTrace.getIdxFromHz(maxFreq)
+	minFrqIdx, maxFrqIdx, posFrqs, posNegFrqs = cache.frequencyGrid(aFilteredTrace, minFreq, maxFreq)
 	nFrq = maxFrqIdx - minFrqIdx
 
+	# a one-sided sigma only holds the positive band, whose negative-band mirror gives an identical image
+	oneSided = (sigma.shape[1] == nFrq)
+
 	# just get the data spectrum limited to frequencies of interest
-	if(minFrqIdx <= 1):
-		subsetSpec = np.hstack((aFilteredTrace.dataSpec[minFrqIdx:maxFrqIdx],aFilteredTrace.dataSpec[1-maxFrqIdx:]))
+	if(oneSided):
+		subsetSpec = aFilteredTrace.getPosSpec(minFrqIdx,maxFrqIdx)
 	else:
-		subsetSpec = np.hstack((aFilteredTrace.dataSpec[minFrqIdx:maxFrqIdx],aFilteredTrace.dataSpec[1-maxFrqIdx:1-minFrqIdx])) 
+		subsetSpec = aFilteredTrace.getSubsetSpec(minFrqIdx,maxFrqIdx)
 
-	# calculate the frequencies of interest
-	actualMinFrq = minFrqIdx*aFilteredTrace.getNHzPerBin()
-	actualMaxFrq = maxFrqIdx*aFilteredTrace.getNHzPerBin()
-	posNegFrqs = np.hstack((np.linspace(actualMinFrq,actualMaxFrq,nFrq),-1*np.flipud(np.linspace(actualMinFrq,actualMaxFrq,nFrq))))
+	# the frequencies of interest
+	if(oneSided):
+		posNegFrqs = posFrqs
 
-	# define the phase shift matrix
-	p = 1.0/velocities #slowness vector
-	nVel = velocities.size
-	phaseShiftMat = np.exp(-2*np.pi*1j*np.outer(p,posNegFrqs))
+	# define the phase shift matrix for this virtual source
+	phaseShiftMat = receiverPhaseShifts(aFilteredTrace.x, velocities, posNegFrqs, -1, sigma.dtype, cache)
 
-	# calculate the dispersion image my multiplying data spectrum by phase shifts
-	dispImgPosNeg = np.tile(np.conj(subsetSpec),(nVel,1))*np.power(phaseShiftMat,aFilteredTrace.x)*sigma
+	with dpf.stage('virtual source image', sigma.nbytes, 16*sigma.size):
+		# calculate the dispersion image my multiplying data spectrum by phase shifts
+		dispImgPosNeg = np.conj(subsetSpec)*phaseShiftMat*sigma
 
-	# symmetrize positive and negative dispersion images
-	dispImg = np.absolute(dispImgPosNeg[:,:nFrq]) + np.absolute(np.fliplr(dispImgPosNeg[:,nFrq:]))
+		# symmetrize positive and negative dispersion images
+		if(oneSided):
+			dispImg = 2*np.absolute(dispImgPosNeg)
+		else:
+			dispImg = np.absolute(dispImgPosNeg[:,:nFrq]) + np.absolute(np.fliplr(dispImgPosNeg[:,nFrq:]))
 
 	return dispImg
 
 
-def dispImgStack2D(traces, velocities, minFreq, maxFreq, filterFunction):
-	'''traces is a list of trace objects (defined in traceClass.py) assumed to all have the same length traces with the same sampling rate. velocities are a 1D numpy array of velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it. This function will return a dispersion image stacked over all virtual sources in traces. The elements will be in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq. It will have been symmetrized for positive and negative frequencies, and all returned values will be non-negative.'''
+def dispImgStack2D(traces, velocities, minFreq, maxFreq, filterFunction, memoryBudget=None, oneSided=False, executor=None, cache=None, nChunks=None, maxWorkers=None):
+	'''traces is a list of trace objects (defined in traceClass.py) assumed to all have the same length traces with the same sampling rate, or a traceClass.TraceGather holding all of them in one array. velocities are a 1D numpy array of velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it (a TraceGather is passed to it whole). memoryBudget is the approximate number of bytes of temporary memory used by each block of receivers or virtual sources (int, defaults to defaultBlockBytes). If oneSided is True the traces are assumed to be real-valued and only the positive frequency band is computed, giving the same image. executor is an optional concurrent.futures thread or process pool over which the receivers of sigma are split into nChunks chunks, maxWorkers of them at once (see dispImgParallel.chunkedSum, both default to the number of CPUs); each running chunk holds its own sigma and memoryBudget of phase shifts. cache is an optional dispImgCache.PhaseShiftCache to keep the phase shifts of sigma in between calls (see sigma2D). This function will return a dispersion image stacked over all virtual sources in traces. The elements will be in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq. It will have been symmetrized for positive and negative frequencies, and all returned values will be non-negative.'''
+
+	if memoryBudget is None:
+		memoryBudget = defaultBlockBytes
+
+	# stack the filtered spectra of all receivers limited to frequencies of interest (nRec x 2*nFrq, or nRec x nFrq if oneSided)
+	subsetSpecs, x, y, posNegFrqs = tr.bandSpectra(traces, minFreq, maxFreq, filterFunction, oneSided)
 
 	# calculate the sigma common factor to all dispersion images
-	sigmaFactor = sigma2D(traces, velocities, minFreq, maxFreq, filterFunction)
+	blockSize = receiverBlockSize(receiverBytes2D(velocities.size, posNegFrqs.size, subsetSpecs.dtype), memoryBudget)
+	if executor is None:
+		sigmaFactor = sigma2DFromSpecs(subsetSpecs, x, velocities, posNegFrqs, blockSize, cache=cache)
+	else:
+		sigmaFactor = dip.chunkedSum(executor, sigma2DFromSpecs, (subsetSpecs, x), (velocities, posNegFrqs, blockSize), (velocities.size, posNegFrqs.size), subsetSpecs.dtype, nChunks, maxWorkers)
+
+	# sum the amplitude spectra of the virtual sources block by block (cheap enough that copying the spectra to workers would cost more)
+	sourceAmplitudes = tr.sumAmplitudeSpectra(subsetSpecs, memoryBudget)
+
+	return dispImgStack2DFromAmplitudes(sourceAmplitudes, sigmaFactor, oneSided)
 
-	# set up zero stack 
-	nVel = velocities.size
-	nFrq = sigmaFactor.shape[1]/2
-	dispImgStack = np.zeros((nVel,nFrq))
 
-	# for each virtual source calculate the dispersion image and add it to the stack
-	for virtualSource in traces:
-		dispImgStack += dispImg2D(virtualSource, velocities, minFreq, maxFreq, sigmaFactor)
 
-	return dispImgStack
\ No newline at end of file
+def dispImgStack2DFromAmplitudes(sourceAmplitudes, sigma, oneSided=False):
+	'''sourceAmplitudes is a 1D numpy array of the 2*nFrq amplitude spectra |spectrum| summed over all virtual sources and sigma is the nVel x 2*nFrq common factor returned by sigma2D(). This returns the symmetrized dispersion image nVel x nFrq stacked over all virtual sources. The phase shifts exp(-2*pi*i*p*f*x) of each virtual source have unit modulus, so the absolute value of a single dispersion image is |spectrum|*|sigma| and the stack only needs the summed amplitude spectra. If oneSided is True, sigma is nVel x nFrq and sourceAmplitudes has nFrq entries for the positive band only, whose negative-band mirror has the same amplitudes.'''
+
+	nVel = sigma.shape[0]
+	nFrq = sigma.shape[1] if oneSided else sigma.shape[1]//2
+
+	# multiply into |sigma| and symmetrize positive and negative frequencies into a preallocated stack
+	with dpf.stage('virtual source stack', sigma.nbytes, 8*sigma.size):
+		dispImgPosNeg = np.absolute(sigma)
+		dispImgPosNeg *= sourceAmplitudes
+		dispImgStack = np.zeros((nVel,nFrq),dtype=dispImgPosNeg.dtype)
+		if(oneSided):
+			dispImgStack += 2*dispImgPosNeg
+		else:
+			dispImgStack += dispImgPosNeg[:,:nFrq]
+			dispImgStack += np.fliplr(dispImgPosNeg[:,nFrq:])
+
+	return dispImgStack
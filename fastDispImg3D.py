@@ -6,49 +6,137 @@ import math
 import numpy as np
 import scipy.fftpack as ft
 import traceClass as tr
+import fastDispImg2D as fdi2
+import dispImgParallel as dip
+import dispImgCache as dic
+import dispImgProfile as dpf
+
+
+# default memory (bytes) used by one block of receivers or virtual sources
+defaultBlockBytes = 2**26
 
 
 ########## calculate sigma, the common factor in all dispersion images ##########
 
 
-def sigma3D(traces, xvelocities, yvelocities, minFreq, maxFreq, filterFunction):
-	'''traces is a list of trace objects (defined in traceClass.py) assumed to all have the same length traces with the same sampling rate. velocities are a 1D numpy array of velocities of interest (m/s) for both the x and y direction. minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it. This calculates the common factor (sigma) in all dispersion images that use these traces as receivers, which is returned as a 2D numpy array nxVel x nyVel x 2*nFrq where nFrq is the number of frequency bins between minFreq and maxFreq. This will return results in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq,-maxFreq,...,-minFreq'''
+def sigma3D(traces, xvelocities, yvelocities, minFreq, maxFreq, filterFunction, blockSize=None, oneSided=False, executor=None, cache=None, nChunks=None, maxWorkers=None):
+	'''traces is a list of trace objects (defined in traceClass.py) assumed to all have the same length traces with the same sampling rate, or a traceClass.TraceGather holding all of them in one array. velocities are a 1D numpy array of velocities of interest (m/s) for both the x and y direction. minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it (a TraceGather is passed to it whole). blockSize is the number of receivers whose phase shifts are formed at once (int, by default chosen so the phase shifts of a block take about defaultBlockBytes of memory). This calculates the common factor (sigma) in all dispersion images that use these traces as receivers, which is returned as a 3D numpy array nxVel x nyVel x 2*nFrq (of the complex type of the trace spectra) where nFrq is the number of frequency bins between minFreq and maxFreq. This will return results in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq,-maxFreq,...,-minFreq. If oneSided is True the traces are assumed to be real-valued, and only the positive band minFreq,...,maxFreq of sigma is computed and returned as an nxVel x nyVel x nFrq array (the negative band is its conjugate, see traceClass.posNegFromPos). executor is an optional concurrent.futures thread or process pool over which the receivers are split into nChunks chunks, maxWorkers of them at once (see dispImgParallel.chunkedSum, both default to the number of CPUs); the result matches the serial one to floating-point rounding. Each running chunk holds its own sigma and block of phase shifts, so the peak memory grows by about maxWorkers times their size (and a process pool also gets a shared copy of the band-limited spectra). cache is an optional dispImgCache.PhaseShiftCache to keep the phase shifts of sigma in between calls with the same geometry; without one they are formed block by block and dropped, so memory stays within the block budget (workers of an executor never keep them).'''
+
+	# stack the filtered spectra of all receivers limited to frequencies of interest (nRec x 2*nFrq, or nRec x nFrq if oneSided)
+	subsetSpecs, x, y, posNegFrqs = tr.bandSpectra(traces, minFreq, maxFreq, filterFunction, oneSided)
+
+	if executor is None:
+		return sigma3DFromSpecs(subsetSpecs, x, y, xvelocities, yvelocities, posNegFrqs, blockSize, cache=cache)
+	return dip.chunkedSum(executor, sigma3DFromSpecs, (subsetSpecs, x, y), (xvelocities, yvelocities, posNegFrqs, blockSize), (xvelocities.size, yvelocities.size, posNegFrqs.size), subsetSpecs.dtype, nChunks, maxWorkers)
+
+
+
+def sigma3DFromSpecs(subsetSpecs, x, y, xvelocities, yvelocities, posNegFrqs, blockSize=None, phaseShiftBlocks=None, cache=None):
+	'''subsetSpecs is a 2D numpy array nRec x 2*nFrq of already filtered band-limited receiver spectra (as returned by traceClass.bandSpectra), x and y are 1D numpy arrays of the nRec receiver positions (m), xvelocities and yvelocities are 1D numpy arrays of velocities of interest (m/s) and posNegFrqs are the 2*nFrq frequencies (Hz) of the columns of subsetSpecs (or the nFrq positive ones for one-sided spectra). blockSize is the number of receivers whose phase shifts are formed at once. phaseShiftBlocks is an optional list of the blocks returned by phaseShiftBlocks3D() for this geometry. Otherwise they are formed one block at a time, unless a cache (a dispImgCache.PhaseShiftCache) is given: then all blocks are formed at once and kept in it whenever they fit, so repeated calls for the same geometry, band and velocities reuse them at the cost of holding them in memory. This returns sigma as a 3D numpy array nxVel x nyVel x posNegFrqs.size (of the complex type of subsetSpecs). The phase shift exp(2*pi*i*f*(px*x+py*y)) is separable, so the x and y factors are kept as 2*nFrq x nVel x nBlock arrays and only combined by one batched matrix product per block of receivers.'''
+
+	if phaseShiftBlocks is None:
+		if blockSize is None:
+			blockSize = fdi2.receiverBlockSize(receiverBytes3D(xvelocities.size, yvelocities.size, posNegFrqs.size, subsetSpecs.dtype), defaultBlockBytes)
+		if cache is None:
+			phaseShiftBlocks = phaseShiftBlocks3D(x, y, xvelocities, yvelocities, posNegFrqs, blockSize, subsetSpecs.dtype)
+		else:
+			key = ('phaseShiftBlocks3D', dic.arrayKey(x), dic.arrayKey(y), dic.arrayKey(xvelocities), dic.arrayKey(yvelocities), dic.arrayKey(posNegFrqs), blockSize, subsetSpecs.dtype.str)
+			nBytes = x.size*(xvelocities.size+yvelocities.size)*posNegFrqs.size*subsetSpecs.itemsize
+			phaseShiftBlocks = cache.getBlocks(key, nBytes, lambda: phaseShiftBlocks3D(x, y, xvelocities, yvelocities, posNegFrqs, blockSize, subsetSpecs.dtype))
+
+	# sigma is accumulated frequency-major so each block is a stack of (nxVel x nBlock) x (nBlock x nyVel) products added to contiguous memory
+	sigmaByFrq = np.zeros((posNegFrqs.size,xvelocities.size,yvelocities.size),dtype=subsetSpecs.dtype)
+	for start, stop, phaseShiftsX, phaseShiftsY in phaseShiftBlocks:
+		with dpf.stage('sigma accumulation', 0, 6*phaseShiftsX.size+8*sigmaByFrq.size*(stop-start)):
+			weightedShiftsX = phaseShiftsX*np.ascontiguousarray(subsetSpecs[start:stop,:].T)[:,np.newaxis,:]
+			sigmaByFrq += np.matmul(weightedShiftsX,phaseShiftsY.transpose(0,2,1))
+		dpf.progress('sigma3D', stop, subsetSpecs.shape[0])
+		phaseShiftsX = phaseShiftsY = weightedShiftsX = None # let go of this block before the next one is formed
+
+	# return an nxVel x nyVel x 2*nFrq array
+	return np.ascontiguousarray(sigmaByFrq.transpose(1,2,0))
+
+
 
-	# define dimensions of sigma
-	nxVel = xvelocities.size
-	nyVel = yvelocities.size
-	minFrqIdx = traces[0].getIdxFromHz(minFreq)
-	maxFrqIdx = traces[0].getIdxFromHz(maxFreq)
-	nFrq = maxFrqIdx-minFrqIdx
-	# initialize the common factor to all dispersion images
-	sigma = np.zeros((nxVel,nyVel,2*nFrq))
+def phaseShiftBlocks3D(x, y, xvelocities, yvelocities, posNegFrqs, blockSize=None, dtype=complex):
+	'''x and y are 1D numpy arrays of the nRec receiver positions (m), xvelocities and yvelocities are 1D numpy arrays of velocities of interest (m/s) and posNegFrqs are the frequencies (Hz) of interest. blockSize is the number of receivers per block (int, by default chosen so each block takes about defaultBlockBytes of memory while it is formed and used, see receiverBytes3D). This generates a tuple (start, stop, phaseShiftsX, phaseShiftsY) for each block of receivers start:stop, where phaseShiftsX is the 3D numpy array 2*nFrq x nxVel x nBlock of exp(2*pi*i*px*f*x) and phaseShiftsY is the 2*nFrq x nyVel x nBlock array of exp(2*pi*i*py*f*y), both of the complex type dtype. A block is only referenced here until the next one is formed.'''
 
-	# calculate the frequencies of interest
-	actualMinFrq = minFrqIdx*traces[0].getNHzPerBin()
-	actualMaxFrq = maxFrqIdx*traces[0].getNHzPerBin()
-	posNegFrqs = np.hstack((np.linspace(actualMinFrq,actualMaxFrq,nFrq),-1*np.flipud(np.linspace(actualMinFrq,actualMaxFrq,nFrq))))
+	nRec = x.size
+	if blockSize is None:
+		blockSize = fdi2.receiverBlockSize(receiverBytes3D(xvelocities.size, yvelocities.size, posNegFrqs.size, dtype), defaultBlockBytes)
 
-	# define the phase shift matrix
+	# phase shift (radians) per meter of receiver position for each frequency and slowness
 	px = 1.0/xvelocities # slowness vector
 	py = 1.0/yvelocities
-	phaseShiftMatX = np.tile(np.reshape(np.exp(2*np.pi*1j*np.outer(px,posNegFrqs)),(nxVel,1,2*nFrq)),(1,nyVel,1))
-	phaseShiftMatY = np.tile(np.exp(2*np.pi*1j*np.outer(py,posNegFrqs)),(nxVel,1,1))
+	phasePerMeterX = 2*np.pi*np.outer(posNegFrqs,px) # 2*nFrq x nxVel
+	phasePerMeterY = 2*np.pi*np.outer(posNegFrqs,py) # 2*nFrq x nyVel
 
-	# for each trace, apply a phase shift to 
-	for r in traces:
+	for start in range(0,nRec,blockSize):
+		stop = min(start+blockSize,nRec)
+		nShifts = posNegFrqs.size*(xvelocities.size+yvelocities.size)*(stop-start)
+		with dpf.stage('phase shifts', nShifts*np.dtype(dtype).itemsize, 20*nShifts):
+			phaseShiftsX = fdi2.expi(np.multiply.outer(phasePerMeterX,x[start:stop]), dtype) # 2*nFrq x nxVel x nBlock
+			phaseShiftsY = fdi2.expi(np.multiply.outer(phasePerMeterY,y[start:stop]), dtype) # 2*nFrq x nyVel x nBlock
+		yield start, stop, phaseShiftsX, phaseShiftsY
+		phaseShiftsX = phaseShiftsY = None
 
-		filterFunction(r) # call user-defined filters
 
-		# just get the spectrum limited to frequencies of interest
-		if(minFrqIdx <= 1):
-			subsetSpec = np.hstack((r.dataSpec[minFrqIdx:maxFrqIdx],r.dataSpec[1-maxFrqIdx:]))
-		else:
-			subsetSpec = np.hstack((r.dataSpec[minFrqIdx:maxFrqIdx],r.dataSpec[1-maxFrqIdx:1-minFrqIdx])) 
 
-		# add phase shifted subset of fourier transform of filtered data to sigma
-		sigma = sigma + np.tile(subsetSpec,(nxVel,nyVel,1))*np.power(phaseShiftMatX,r.x)*np.power(phaseShiftMatY,r.y)
+def receiverBytes3D(nxVel, nyVel, nCols, dtype=complex):
+	'''Get the bytes (int) held per receiver of a block of phaseShiftBlocks3D() with nxVel and nyVel velocities and nCols frequencies of the complex type dtype, at the largest of the moments its x phase shifts are formed from their double precision angles, its y phase shifts are formed next to the x ones, and sigma3DFromSpecs weights a copy of the x phase shifts by the spectra'''
+	itemBytes = np.dtype(dtype).itemsize
+	return nCols*max(nxVel*(itemBytes+8), nxVel*itemBytes+nyVel*(itemBytes+8), (2*nxVel+nyVel)*itemBytes)
 
-	# return an nxVel x nyVel x 2*nFrq array
+
+
+def planSigma3D(nRec, nSamples, dt, xvelocities, yvelocities, minFreq, maxFreq, dtype=complex, oneSided=False, memoryLimit=None, blockBytes=None, frqRefinement=1):
+	'''Estimate the cost of sigma3D() for nRec receivers recording nSamples samples spaced dt (s) apart, before any data are read. xvelocities, yvelocities, minFreq, maxFreq and oneSided are as in sigma3D(), dtype and frqRefinement are the complex type (complex, or np.complex64 to halve the memory) and the frequency refinement of the trace spectra (see traceClass.TraceGather) and blockBytes is the most memory for one block of receivers while its x and y phase shifts are formed and used (bytes, defaults to defaultBlockBytes, see receiverBytes3D). This returns a dict (see fastDispImg2D.sigmaPlan()) with the largest block of receivers that keeps the estimated peak memory under memoryLimit bytes, and whose entry 'fits' tells whether any block does.'''
+
+	# frequency bins of the band, as in traceClass.bandSpectra
+	grid = tr.frequencyGrid()
+	grid.dt = dt
+	grid.nSamples = nSamples
+	grid.frqRefinement = frqRefinement
+	nFrq = grid.getIdxFromHz(maxFreq)-grid.getIdxFromHz(minFreq)
+	nCols = nFrq if oneSided else 2*nFrq
+	return fdi2.sigmaPlan(nRec, nFrq, nCols, xvelocities.size*yvelocities.size, xvelocities.size+yvelocities.size, receiverBytes3D(xvelocities.size, yvelocities.size, nCols, dtype), dtype, memoryLimit, blockBytes)
+
+
+
+########## calculate sigma for receivers on a regular grid ##########
+
+
+def sigma3DRegular(traces, xvelocities, yvelocities, minFreq, maxFreq, filterFunction, dx=None, dy=None, oneSided=False, spreadWidth=12):
+	'''Same as sigma3D() for receivers on a regular x-y grid (gridded nodal layouts, missing nodes are allowed). dx and dy are the grid spacings (m), by default the smallest distances between receivers in each direction. The sum over receivers at each frequency is a 2D spatial Fourier series evaluated at the wavenumbers f/xvelocities and f/yvelocities, which is computed as two passes of the non-uniform FFT fastDispImg2D.slantSum, one along y and one along x. spreadWidth (int) sets the accuracy: 12 gives about 1e-11 relative error. This returns sigma as a 3D numpy array nxVel x nyVel x 2*nFrq (nxVel x nyVel x nFrq if oneSided) like sigma3D().'''
+
+	# stack the filtered spectra of all receivers limited to frequencies of interest (nRec x 2*nFrq, or nRec x nFrq if oneSided)
+	subsetSpecs, x, y, posNegFrqs = tr.bandSpectra(traces, minFreq, maxFreq, filterFunction, oneSided)
+
+	return sigma3DRegularFromSpecs(subsetSpecs, x, y, xvelocities, yvelocities, posNegFrqs, dx, dy, spreadWidth)
+
+
+
+def sigma3DRegularFromSpecs(subsetSpecs, x, y, xvelocities, yvelocities, posNegFrqs, dx=None, dy=None, spreadWidth=12):
+	'''subsetSpecs is a 2D numpy array nRec x 2*nFrq of already filtered band-limited receiver spectra (as returned by traceClass.bandSpectra), x and y are 1D numpy arrays of the nRec receiver positions (m) on a regular grid with spacings dx and dy (m, by default detected by fastDispImg2D.regularPositions), xvelocities and yvelocities are 1D numpy arrays of velocities of interest (m/s) and posNegFrqs are the frequencies (Hz) of the columns of subsetSpecs. This returns sigma as a 3D numpy array nxVel x nyVel x posNegFrqs.size.'''
+
+	# place the spectra on the regular grid of receiver positions (frequency-major)
+	x0, dx, mx = fdi2.regularPositions(x, dx)
+	y0, dy, my = fdi2.regularPositions(y, dy)
+	gridSpecs = np.zeros((posNegFrqs.size,mx.max()+1,my.max()+1),dtype=subsetSpecs.dtype)
+	np.add.at(gridSpecs.transpose(1,2,0),(mx,my),subsetSpecs)
+
+	# sum over y at wavenumbers f*py, then over x at wavenumbers f*px
+	px = 1.0/xvelocities # slowness vector
+	py = 1.0/yvelocities
+	with dpf.stage('slant stack', gridSpecs.shape[0]*gridSpecs.shape[1]*py.size*subsetSpecs.itemsize, fdi2.slantSumFlops(gridSpecs.shape, py.size, spreadWidth)):
+		sumY = fdi2.slantSum(gridSpecs, dy*np.outer(posNegFrqs,py), spreadWidth) # 2*nFrq x nxGrid x nyVel
+	with dpf.stage('slant stack', gridSpecs.shape[0]*py.size*px.size*subsetSpecs.itemsize, fdi2.slantSumFlops(sumY.transpose(0,2,1).shape, px.size, spreadWidth)):
+		sumXY = fdi2.slantSum(sumY.transpose(0,2,1), dx*np.outer(posNegFrqs,px), spreadWidth) # 2*nFrq x nyVel x nxVel
+
+	# shift the phases by the grid origin and return an nxVel x nyVel x 2*nFrq array
+	sigma = np.ascontiguousarray(sumXY.transpose(2,1,0))
+	sigma *= fdi2.expi(2*np.pi*x0*np.outer(px,posNegFrqs), sigma.dtype)[:,np.newaxis,:]
+	sigma *= fdi2.expi(2*np.pi*y0*np.outer(py,posNegFrqs), sigma.dtype)[np.newaxis,:,:]
 	return sigma
 
 
@@ -56,38 +144,42 @@ def sigma3D(traces, xvelocities, yvelocities, minFreq, maxFreq, filterFunction):
 ############## calculate dispersion image with one virtual source ##############
 
 
-def dispImg3D(aFilteredTrace, xvelocities, yvelocities, minFreq, maxFreq, sigma):
-	'''aFilteredTrace is a trace object (defined in traceClass.py) assumed to have already been filtered that will act as a virtual source for this dispersion image. minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). velocities are a 1D numpy array of velocities of interest in the x and y directions (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). sigma is the common factor in all dispersion images that use these traces as receivers, which is returned by sigma2D() as a 2D numpy array nxVel x nyVel x 2*nFrq where nFrq is the number of frequency bins between minFreq and maxFreq. The sigma matrix will be in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq,-maxFreq,...,-minFreq. This function will return a 3D dispersion image in the order velocities[0],velocities[1],...,velocities[-1] in the first and second dimensions and in the third direction minFreq,...,maxFreq. It will have been symmetrized for positive and negative frequencies, and all returned values will be non-negative.'''
+def dispImg3D(aFilteredTrace, xvelocities, yvelocities, minFreq, maxFreq, sigma, cache=None):
+	'''aFilteredTrace is a trace object (defined in traceClass.py) assumed to have already been filtered that will act as a virtual source for this dispersion image. minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). velocities are a 1D numpy array of velocities of interest in the x and y directions (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). sigma is the common factor in all dispersion images that use these traces as receivers, which is returned by sigma3D() as a 3D numpy array nxVel x nyVel x 2*nFrq (or nxVel x nyVel x nFrq if it was computed oneSided) where nFrq is the number of frequency bins between minFreq and maxFreq. The sigma matrix will be in the order velocities[0],velocities[1],...,velocities[-1] and in the other direction minFreq,...,maxFreq,-maxFreq,...,-minFreq. This function will return a 3D dispersion image in the order velocities[0],velocities[1],...,velocities[-1] in the first and second dimensions and in the third direction minFreq,...,maxFreq. It will have been symmetrized for positive and negative frequencies, and all returned values will be non-negative. The frequency grid and the x and y phase shifts of the virtual source are kept in cache (a dispImgCache.PhaseShiftCache, defaults to dispImgCache.defaultCache), so imaging many windows with the same virtual sources only forms them once.'''
+
+	if cache is None:
+		cache = dic.defaultCache
 
 	# define dimensions of spectrum of interest
-	minFrqIdx = aFilteredTrace.getIdxFromHz(minFreq)
-	maxFrqIdx = aFilteredTrace.getIdxFromHz(maxFreq)
+	minFrqIdx, maxFrqIdx, posFrqs, posNegFrqs = cache.frequencyGrid(aFilteredTrace, minFreq, maxFreq)
 	nFrq = maxFrqIdx - minFrqIdx
 
+	# a one-sided sigma only holds the positive band, whose negative-band mirror gives an identical image
+	oneSided = (sigma.shape[2] == nFrq)
+
 	# just get the data spectrum limited to frequencies of interest
-	if(minFrqIdx <= 1):
-		subsetSpec = np.hstack((aFilteredTrace.dataSpec[minFrqIdx:maxFrqIdx],aFilteredTrace.dataSpec[1-maxFrqIdx:]))
+	if(oneSided):
+		subsetSpec = aFilteredTrace.getPosSpec(minFrqIdx,maxFrqIdx)
 	else:
-		subsetSpec = np.hstack((aFilteredTrace.dataSpec[minFrqIdx:maxFrqIdx],aFilteredTrace.dataSpec[1-maxFrqIdx:1-minFrqIdx])) 
+		subsetSpec = aFilteredTrace.getSubsetSpec(minFrqIdx,maxFrqIdx)
 
-	# calculate the frequencies of interest
-	actualMinFrq = minFrqIdx*aFilteredTrace.getNHzPerBin()
-	actualMaxFrq = maxFrqIdx*aFilteredTrace.getNHzPerBin()
-	posNegFrqs = np.hstack((np.linspace(actualMinFrq,actualMaxFrq,nFrq),-1*np.flipud(np.linspace(actualMinFrq,actualMaxFrq,nFrq))))
+	# the frequencies of interest
+	if(oneSided):
+		posNegFrqs = posFrqs
 
-	# define the phase shift matrix
-	px = 1.0/xvelocities #slowness vector
-	py = 1.0/yvelocities # slowness vector
-	nxVel = xvelocities.size
-	nyVel = yvelocities.size
-	phaseShiftMatX = np.tile(np.reshape(np.exp(-2*np.pi*1j*np.outer(px,posNegFrqs)),(nxVel,1,2*nFrq)),(1,nyVel,1))
-	phaseShiftMatY = np.tile(np.exp(-2*np.pi*1j*np.outer(py,posNegFrqs)),(nxVel,1,1))
+	# define the separable x and y phase shifts for this virtual source
+	phaseShiftMatX = fdi2.receiverPhaseShifts(aFilteredTrace.x, xvelocities, posNegFrqs, -1, sigma.dtype, cache) # nxVel x 2*nFrq
+	phaseShiftMatY = fdi2.receiverPhaseShifts(aFilteredTrace.y, yvelocities, posNegFrqs, -1, sigma.dtype, cache) # nyVel x 2*nFrq
 
-	# calculate the dispersion image my multiplying data spectrum by phase shifts
-	dispImgPosNeg = np.tile(np.conj(subsetSpec),(nxVel,nyVel,1))*np.power(phaseShiftMatX,aFilteredTrace.x)*np.power(phaseShiftMatY,aFilteredTrace.y)*sigma
+	with dpf.stage('virtual source image', sigma.nbytes, 16*sigma.size):
+		# calculate the dispersion image my multiplying data spectrum by phase shifts
+		dispImgPosNeg = (np.conj(subsetSpec)*phaseShiftMatX)[:,np.newaxis,:]*phaseShiftMatY[np.newaxis,:,:]*sigma
 
-	# symmetrize positive and negative dispersion images
-	dispImg = np.absolute(dispImgPosNeg[:,:,:nFrq]) + np.absolute(np.fliplr(dispImgPosNeg[:,:,nFrq:]))
+		# symmetrize positive and negative dispersion images
+		if(oneSided):
+			dispImg = 2*np.absolute(dispImgPosNeg)
+		else:
+			dispImg = np.absolute(dispImgPosNeg[:,:,:nFrq]) + np.absolute(dispImgPosNeg[:,:,nFrq:][:,:,::-1])
 
 	return dispImg
 
@@ -96,20 +188,45 @@ def dispImg3D(aFilteredTrace, xvelocities, yvelocities, minFreq, maxFreq, sigma)
 
 ############ calculate a stack of dispersion images ########################
 
-def dispImgStack3D(traces, xvelocities, yvelocities, minFreq, maxFreq, filterFunction):
-	'''traces is a list of trace objects (defined in traceClass.py) assumed to all have the same length traces with the same sampling rate. velocities are a 1D numpy array of x and y velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it. This function will return a 3D dispersion image in the order velocities[0],velocities[1],...,velocities[-1] in the first and second dimensions and in the third direction minFreq,...,maxFreq. It will have been symmetrized for positive and negative frequencies, and all returned values will be non-negative.'''
+def dispImgStack3D(traces, xvelocities, yvelocities, minFreq, maxFreq, filterFunction, memoryBudget=None, oneSided=False, executor=None, cache=None, nChunks=None, maxWorkers=None):
+	'''traces is a list of trace objects (defined in traceClass.py) assumed to all have the same length traces with the same sampling rate, or a traceClass.TraceGather holding all of them in one array. velocities are a 1D numpy array of x and y velocities of interest (m/s). minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it (a TraceGather is passed to it whole). memoryBudget is the approximate number of bytes of temporary memory used by each block of receivers or virtual sources (int, defaults to defaultBlockBytes). If oneSided is True the traces are assumed to be real-valued and only the positive frequency band is computed, giving the same image. executor is an optional concurrent.futures thread or process pool over which the receivers of sigma are split into nChunks chunks, maxWorkers of them at once (see dispImgParallel.chunkedSum, both default to the number of CPUs); each running chunk holds its own sigma and memoryBudget of phase shifts. cache is an optional dispImgCache.PhaseShiftCache to keep the phase shifts of sigma in between calls (see sigma3D). This function will return a 3D dispersion image in the order velocities[0],velocities[1],...,velocities[-1] in the first and second dimensions and in the third direction minFreq,...,maxFreq. It will have been symmetrized for positive and negative frequencies, and all returned values will be non-negative.'''
+
+	if memoryBudget is None:
+		memoryBudget = defaultBlockBytes
+
+	# stack the filtered spectra of all receivers limited to frequencies of interest (nRec x 2*nFrq, or nRec x nFrq if oneSided)
+	subsetSpecs, x, y, posNegFrqs = tr.bandSpectra(traces, minFreq, maxFreq, filterFunction, oneSided)
 
 	# calculate the sigma common factor to all dispersion images
-	sigmaFactor = sigma3D(traces, xvelocities, yvelocities, minFreq, maxFreq, filterFunction)
+	blockSize = fdi2.receiverBlockSize(receiverBytes3D(xvelocities.size, yvelocities.size, posNegFrqs.size, subsetSpecs.dtype), memoryBudget)
+	if executor is None:
+		sigmaFactor = sigma3DFromSpecs(subsetSpecs, x, y, xvelocities, yvelocities, posNegFrqs, blockSize, cache=cache)
+	else:
+		sigmaFactor = dip.chunkedSum(executor, sigma3DFromSpecs, (subsetSpecs, x, y), (xvelocities, yvelocities, posNegFrqs, blockSize), (xvelocities.size, yvelocities.size, posNegFrqs.size), subsetSpecs.dtype, nChunks, maxWorkers)
+
+	# sum the amplitude spectra of the virtual sources block by block (cheap enough that copying the spectra to workers would cost more)
+	sourceAmplitudes = tr.sumAmplitudeSpectra(subsetSpecs, memoryBudget)
 
-	# set up zero stack 
-	nxVel = xvelocities.size
-	nyVel = yvelocities.size 
-	nFrq = sigmaFactor.shape[2]/2
-	dispImgStack = np.zeros((nxVel,nyVel,nFrq))
+	return dispImgStack3DFromAmplitudes(sourceAmplitudes, sigmaFactor, oneSided)
 
-	# for each virtual source calculate the dispersion image and add it to the stack
-	for virtualSource in traces:
-		dispImgStack += dispImg3D(virtualSource, xvelocities, yvelocities, minFreq, maxFreq, sigmaFactor)
 
-	return dispImgStack
\ No newline at end of file
+
+def dispImgStack3DFromAmplitudes(sourceAmplitudes, sigma, oneSided=False):
+	'''sourceAmplitudes is a 1D numpy array of the 2*nFrq amplitude spectra |spectrum| summed over all virtual sources and sigma is the nxVel x nyVel x 2*nFrq common factor returned by sigma3D(). This returns the symmetrized dispersion image nxVel x nyVel x nFrq stacked over all virtual sources. The phase shifts of each virtual source have unit modulus, so the absolute value of a single dispersion image is |spectrum|*|sigma| and the stack only needs the summed amplitude spectra. If oneSided is True, sigma is nxVel x nyVel x nFrq and sourceAmplitudes has nFrq entries for the positive band only, whose negative-band mirror has the same amplitudes.'''
+
+	nxVel = sigma.shape[0]
+	nyVel = sigma.shape[1]
+	nFrq = sigma.shape[2] if oneSided else sigma.shape[2]//2
+
+	# multiply into |sigma| and symmetrize positive and negative frequencies into a preallocated stack
+	with dpf.stage('virtual source stack', sigma.nbytes, 8*sigma.size):
+		dispImgPosNeg = np.absolute(sigma)
+		dispImgPosNeg *= sourceAmplitudes
+		dispImgStack = np.zeros((nxVel,nyVel,nFrq),dtype=dispImgPosNeg.dtype)
+		if(oneSided):
+			dispImgStack += 2*dispImgPosNeg
+		else:
+			dispImgStack += dispImgPosNeg[:,:,:nFrq]
+			dispImgStack += dispImgPosNeg[:,:,nFrq:][:,:,::-1]
+
+	return dispImgStack
@@ -0,0 +1,92 @@
+########### Regression tests comparing the accumulators of dispImgAccumulator with stacks computed from scratch.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import numpy as np
+import pytest
+import traceClass as tr
+import fastDispImg2D as fdi2
+import fastDispImg3D as fdi3
+import dispImgAccumulator as dia
+
+
+dt = 0.004
+nRec = 9
+nSamples = 600
+minFreq = 5.0
+maxFreq = 30.0
+velocities = np.linspace(200,2000,20)
+filterFunction = tr.filterChain(('scale_data',2.0),('whiten_spec',3))
+
+
+def makeWindows(nWindows):
+	'''Get a reproducible list of nWindows nRec x nSamples arrays of random data and the receiver positions'''
+	rng = np.random.default_rng(5)
+	return [rng.standard_normal((nRec,nSamples)) for w in range(nWindows)], np.arange(nRec)*10.0, rng.uniform(0,50,nRec)
+
+def stack2D(windows, x, receivers):
+	'''Get the 2D stack over windows of the receivers listed for each window, computed from scratch'''
+	return sum(fdi2.dispImgStack2D(tr.TraceGather(data[rec],dt,x[rec]),velocities,minFreq,maxFreq,filterFunction) for data, rec in zip(windows,receivers))
+
+def relativeError(a, b):
+	return np.abs(a-b).max()/np.abs(b).max()
+
+
+@pytest.mark.parametrize('keepSpectra', [True, False])
+def test_addAndRemoveReceivers(keepSpectra):
+	windows, x, y = makeWindows(2)
+	acc = dia.SigmaAccumulator2D(dt,nSamples,velocities,minFreq,maxFreq,keepSpectra)
+	gathers = [tr.TraceGather(data,dt,x) for data in windows]
+	windowIds = [acc.addWindow(g,filterFunction) for g in gathers]
+	everyone = list(range(nRec))
+	assert relativeError(acc.getDispImgStack(),stack2D(windows,x,[everyone,everyone])) < 1e-12
+
+	# a trace of the filtered gather, and a raw trace that is left as it was
+	acc.removeReceiver(4,windowIds[0],gathers[0].getTrace(4),filterFunction)
+	raw = tr.trace(windows[1][6].copy(),dt,x[6])
+	acc.removeReceiver(6,windowIds[1],raw,filterFunction)
+	assert np.array_equal(raw.data,windows[1][6])
+	without = [[i for i in everyone if i != 4],[i for i in everyone if i != 6]]
+	assert relativeError(acc.getDispImgStack(),stack2D(windows,x,without)) < 1e-12
+
+	# adding it back leaves the raw trace as it was too
+	acc.addReceiver(windowIds[1],6,raw,filterFunction)
+	assert np.array_equal(raw.data,windows[1][6])
+	assert relativeError(acc.getDispImgStack(),stack2D(windows,x,[without[0],everyone])) < 1e-12
+
+def test_removeReceiverByName():
+	windows, x, y = makeWindows(3)
+	acc = dia.SigmaAccumulator2D(dt,nSamples,velocities,minFreq,maxFreq)
+	for data in windows:
+		acc.addWindow(tr.TraceGather(data,dt,x),filterFunction)
+	acc.removeReceiver(2)
+	without = [i for i in range(nRec) if i != 2]
+	assert relativeError(acc.getDispImgStack(),stack2D(windows,x,[without]*3)) < 1e-12
+
+def test_removeReceiverNeedsMatchingTrace():
+	windows, x, y = makeWindows(1)
+	acc = dia.SigmaAccumulator2D(dt,nSamples,velocities,minFreq,maxFreq,keepSpectra=False)
+	windowId = acc.addWindow(tr.TraceGather(windows[0],dt,x),filterFunction)
+	with pytest.raises(ValueError):
+		acc.removeReceiver(3)
+	with pytest.raises(ValueError):
+		acc.removeReceiver(3,windowId,tr.trace(windows[0][5].copy(),dt,x[3]),filterFunction)
+
+def test_addAndRemoveWindows():
+	windows, x, y = makeWindows(3)
+	acc = dia.SigmaAccumulator2D(dt,nSamples,velocities,minFreq,maxFreq)
+	windowIds = [acc.addWindow([tr.trace(row.copy(),dt,xi) for row, xi in zip(data,x)],filterFunction) for data in windows]
+	acc.removeWindow(windowIds[1])
+	everyone = list(range(nRec))
+	assert relativeError(acc.getDispImgStack(),stack2D([windows[0],windows[2]],x,[everyone,everyone])) < 1e-12
+	assert relativeError(acc.getSigma(windowIds[0]),fdi2.sigma2D(tr.TraceGather(windows[0],dt,x),velocities,minFreq,maxFreq,filterFunction,oneSided=True)) < 1e-12
+
+def test_accumulator3D():
+	windows, x, y = makeWindows(2)
+	acc = dia.SigmaAccumulator3D(dt,nSamples,velocities,velocities,minFreq,maxFreq,keepSpectra=False)
+	gathers = [tr.TraceGather(data,dt,x,y) for data in windows]
+	windowIds = [acc.addWindow(g,filterFunction) for g in gathers]
+	acc.removeReceiver(1,windowIds[0],gathers[0].getTrace(1),filterFunction)
+	without = [i for i in range(nRec) if i != 1]
+	expected = fdi3.dispImgStack3D(tr.TraceGather(windows[0][without],dt,x[without],y[without]),velocities,velocities,minFreq,maxFreq,filterFunction)
+	expected += fdi3.dispImgStack3D(tr.TraceGather(windows[1],dt,x,y),velocities,velocities,minFreq,maxFreq,filterFunction)
+	assert relativeError(acc.getDispImgStack(),expected) < 1e-12
@@ -0,0 +1,125 @@
+########### Regression tests for saving, loading, merging and resuming from dispImgCheckpoint checkpoints.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import os
+import numpy as np
+import pytest
+import traceClass as tr
+import fastDispImg2D as fdi2
+import fastDispImg3D as fdi3
+import dispImgCheckpoint as dck
+import dispImgStream as dis
+
+
+dt = 0.004
+nRec = 8
+nSamples = 400
+minFreq = 5.0
+maxFreq = 30.0
+velocities = np.linspace(200,2000,15)
+filterFunction = tr.filterChain(('normalize_oneBit',))
+
+
+def makeRecord(nWindows):
+	'''Get a reproducible nRec x (nWindows*nSamples) continuous record of random data and the receiver positions'''
+	rng = np.random.default_rng(9)
+	return rng.standard_normal((nRec,nWindows*nSamples)), np.arange(nRec)*12.0, rng.uniform(0,40,nRec)
+
+def stack2D(record, x):
+	'''Get the 2D stack over all windows of record, computed from scratch'''
+	return sum(fdi2.dispImgStack2D(tr.TraceGather(window,dt,x),velocities,minFreq,maxFreq,filterFunction) for window in dis.slidingWindows(record,nSamples))
+
+def relativeError(a, b):
+	return np.abs(a-b).max()/np.abs(b).max()
+
+def crashAfter(windows, nWindows):
+	'''Generate the first nWindows of windows, then raise a RuntimeError as if the job died'''
+	for i, window in enumerate(windows):
+		if(i == nWindows):
+			raise RuntimeError("job died")
+		yield window
+
+
+def test_saveAndLoad(tmp_path):
+	record, x, y = makeRecord(1)
+	gather = tr.TraceGather(record,dt,x)
+	sigma = fdi2.sigma2D(gather,velocities,minFreq,maxFreq,filterFunction,oneSided=True)
+	path = str(tmp_path/'sigma')
+	dck.Checkpoint('sigma',sigma,dt,nSamples,minFreq,maxFreq,x,velocities=velocities).save(path)
+	loaded = dck.Checkpoint.load(path)
+	assert np.array_equal(loaded.data,sigma)
+	assert np.array_equal(loaded.grids['velocities'],velocities)
+	with pytest.raises(ValueError):
+		loaded.checkCompatible(dck.Checkpoint('sigma',None,dt,nSamples,minFreq,maxFreq+5,x,velocities=velocities))
+	with pytest.raises(FileNotFoundError):
+		dck.Checkpoint.load(str(tmp_path/'missing'))
+
+def test_mergeStacks(tmp_path):
+	record, x, y = makeRecord(4)
+	windows = list(dis.slidingWindows(record,nSamples))
+	paths = []
+	for part in (windows[:1],windows[1:]):
+		path = str(tmp_path/('part'+str(len(paths))))
+		stack = sum(fdi2.dispImgStack2D(tr.TraceGather(window,dt,x),velocities,minFreq,maxFreq,filterFunction) for window in part)
+		dck.Checkpoint('stack',stack,dt,nSamples,minFreq,maxFreq,x,velocities=velocities,nWindows=len(part)).save(path)
+		paths.append(path)
+	merged = dck.mergeCheckpointFiles(paths,paths[0])
+	assert merged.nWindows == 4
+	assert relativeError(dck.Checkpoint.load(paths[0]).data,stack2D(record,x)) < 1e-12
+
+def test_mergeSigmas():
+	record, x, y = makeRecord(1)
+	parts = [slice(0,3),slice(3,nRec)]
+	checkpoints = [dck.Checkpoint('sigma',fdi3.sigma3D(tr.TraceGather(record[p],dt,x[p],y[p]),velocities,velocities,minFreq,maxFreq,filterFunction,oneSided=True),dt,nSamples,minFreq,maxFreq,x[p],y[p],xvelocities=velocities,yvelocities=velocities) for p in parts]
+	merged = dck.mergeCheckpoints(checkpoints)
+	expected = fdi3.sigma3D(tr.TraceGather(record,dt,x,y),velocities,velocities,minFreq,maxFreq,filterFunction,oneSided=True)
+	assert relativeError(merged.data,expected) < 1e-12
+	assert np.array_equal(merged.grids['x'],x)
+
+def test_resumeStream2D(tmp_path):
+	record, x, y = makeRecord(5)
+	path = str(tmp_path/'stack')
+	with pytest.raises(RuntimeError):
+		for result in dis.streamDispImgStack2D(crashAfter(dis.slidingWindows(record,nSamples),3),dt,x,velocities,minFreq,maxFreq,filterFunction,checkpointPath=path,checkpointEvery=2):
+			pass
+	assert dck.Checkpoint.load(path).nWindows == 2
+	nWindows, stack = list(dis.streamDispImgStack2D(dis.slidingWindows(record,nSamples),dt,x,velocities,minFreq,maxFreq,filterFunction,checkpointPath=path))[-1]
+	assert nWindows == 5
+	assert relativeError(stack,stack2D(record,x)) < 1e-12
+	assert dck.Checkpoint.load(path).nWindows == 5
+
+def test_resumeStream3D(tmp_path):
+	record, x, y = makeRecord(3)
+	path = str(tmp_path/'stack')
+	with pytest.raises(RuntimeError):
+		for result in dis.streamDispImgStack3D(crashAfter(dis.slidingWindows(record,nSamples),2),dt,x,y,velocities,velocities,minFreq,maxFreq,filterFunction,checkpointPath=path,checkpointEvery=1):
+			pass
+	nWindows, stack = list(dis.streamDispImgStack3D(dis.slidingWindows(record,nSamples),dt,x,y,velocities,velocities,minFreq,maxFreq,filterFunction,checkpointPath=path))[-1]
+	expected = sum(fdi3.dispImgStack3D(tr.TraceGather(window,dt,x,y),velocities,velocities,minFreq,maxFreq,filterFunction) for window in dis.slidingWindows(record,nSamples))
+	assert nWindows == 3
+	assert relativeError(stack,expected) < 1e-12
+
+@pytest.mark.parametrize('nRenames', [0, 1])
+def test_resumeAfterInterruptedSave(tmp_path, monkeypatch, nRenames):
+	# the job dies while swapping the checkpoint of 4 windows in for the one of 2, after nRenames of its renames
+	record, x, y = makeRecord(5)
+	path = str(tmp_path/'stack')
+	rename = os.rename
+	renames = []
+	def dyingRename(src, dst):
+		if(len(renames) == nRenames):
+			raise RuntimeError("job died")
+		renames.append(src)
+		rename(src,dst)
+	with pytest.raises(RuntimeError):
+		for nWindows, stack in dis.streamDispImgStack2D(dis.slidingWindows(record,nSamples),dt,x,velocities,minFreq,maxFreq,filterFunction,yieldEvery=2,checkpointPath=path,checkpointEvery=2):
+			monkeypatch.setattr(os,'rename',dyingRename)
+	monkeypatch.setattr(os,'rename',rename)
+	assert os.path.exists(path) == (nRenames == 0)
+	assert dck.Checkpoint.load(path).nWindows == 4
+
+	# resuming skips the 4 saved windows, and the next save cleans up
+	nWindows, stack = list(dis.streamDispImgStack2D(dis.slidingWindows(record,nSamples),dt,x,velocities,minFreq,maxFreq,filterFunction,checkpointPath=path))[-1]
+	assert nWindows == 5
+	assert relativeError(stack,stack2D(record,x)) < 1e-12
+	assert sorted(os.listdir(str(tmp_path))) == ['stack']
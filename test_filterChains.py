@@ -0,0 +1,82 @@
+########### Regression tests comparing the filters of TraceGather with those of lists of traces.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import numpy as np
+import pytest
+import traceClass as tr
+import fastDispImg2D as fdi2
+
+
+dt = 0.004
+nRec = 8
+nSamples = 1000
+minFreq = 5.0
+maxFreq = 30.0
+
+chains = [
+	(('normalize_oneBit',),('whiten_spec',5)),
+	(('whiten_spec',5),('normalize_oneBit',)),
+	(('whiten_spec',3),('scale_data',3.0)),
+	(('scale_data',-2.0),('normalize_runningAbsMean',20),('whiten_spec',2),('scale_data',0.5)),
+	(('taper_data',0.1),('whiten_spec',4),('bandpass_spec',8.0,25.0,2.0)),
+]
+
+
+def makeData():
+	'''Get a reproducible nRec x nSamples array of random data and the receiver positions'''
+	rng = np.random.default_rng(3)
+	return rng.standard_normal((nRec,nSamples)), np.arange(nRec)*10.0
+
+def traceSpecs(data, x, steps, minFrqIdx, maxFrqIdx):
+	'''Get the positive band of every row of data filtered as a trace'''
+	filterFunction = tr.filterChain(*steps)
+	specs = []
+	for i in range(nRec):
+		r = tr.trace(data[i],dt,x[i])
+		filterFunction(r)
+		specs.append(r.getPosSpec(minFrqIdx,maxFrqIdx))
+	return np.array(specs)
+
+def relativeError(a, b):
+	return np.abs(a-b).max()/np.abs(b).max()
+
+
+@pytest.mark.parametrize('steps', chains)
+def test_gatherMatchesTraces(steps):
+	data, x = makeData()
+	gather = tr.TraceGather(data,dt,x)
+	tr.filterChain(*steps)(gather)
+	minFrqIdx = gather.getIdxFromHz(minFreq)
+	maxFrqIdx = gather.getIdxFromHz(maxFreq)
+	expected = traceSpecs(data,x,steps,minFrqIdx,maxFrqIdx)
+	assert relativeError(gather.getPosSpecs(minFrqIdx,maxFrqIdx),expected) < 1e-12
+	assert relativeError(gather.getTrace(2).getPosSpec(minFrqIdx,maxFrqIdx),expected[2]) < 1e-12
+
+@pytest.mark.parametrize('steps', chains)
+def test_gatherStackMatchesTraces(steps):
+	data, x = makeData()
+	velocities = np.linspace(200,2000,20)
+	filterFunction = tr.filterChain(*steps)
+	fromGather = fdi2.dispImgStack2D(tr.TraceGather(data,dt,x),velocities,minFreq,maxFreq,filterFunction)
+	fromTraces = fdi2.dispImgStack2D([tr.trace(data[i],dt,x[i]) for i in range(nRec)],velocities,minFreq,maxFreq,filterFunction)
+	assert relativeError(fromGather,fromTraces) < 1e-12
+
+def test_filterOrderDoesNotMatter():
+	# the band is the same whether it is computed before or after the filters are added
+	data, x = makeData()
+	later = tr.TraceGather(data,dt,x)
+	later.whiten_spec(5)
+	later.scale_data(3.0)
+	earlier = tr.TraceGather(data,dt,x)
+	earlier.getPosSpecs(10,100)
+	earlier.whiten_spec(5)
+	earlier.scale_data(3.0)
+	assert relativeError(earlier.getPosSpecs(10,100),later.getPosSpecs(10,100)) < 1e-12
+
+def test_whitenDoesNotDependOnBand():
+	data, x = makeData()
+	wide = tr.TraceGather(data,dt,x)
+	wide.whiten_spec(5)
+	narrow = tr.TraceGather(data,dt,x)
+	narrow.whiten_spec(5)
+	assert relativeError(narrow.getPosSpecs(40,60),wide.getPosSpecs(10,200)[:,30:50]) < 1e-12
@@ -0,0 +1,65 @@
+########### Regression tests comparing the memory planned by planSigma2D and planSigma3D with the memory sigma takes.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import tracemalloc
+import numpy as np
+import pytest
+import traceClass as tr
+import fastDispImg2D as fdi2
+import fastDispImg3D as fdi3
+
+
+dt = 0.004
+nRec = 120
+nSamples = 1000
+minFreq = 1.0
+maxFreq = 60.0
+
+
+def bandSpecs(dtype, oneSided):
+	'''Get the band-limited spectra of reproducible random data of the complex type dtype, with the receiver positions and frequencies'''
+	rng = np.random.default_rng(11)
+	gather = tr.TraceGather(rng.standard_normal((nRec,nSamples)),dt,rng.uniform(0,2000,nRec),rng.uniform(0,2000,nRec),dtype)
+	return tr.bandSpectra(gather,minFreq,maxFreq,lambda g: None,oneSided)
+
+def peakBytes(function):
+	'''Get the most memory (bytes) allocated at once while function() runs'''
+	tracemalloc.start()
+	try:
+		function()
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+
+@pytest.mark.parametrize('dtype', [complex, np.complex64])
+@pytest.mark.parametrize('memoryLimit', [4*2**20, None])
+def test_planSigma2D(dtype, memoryLimit):
+	velocities = np.linspace(200,2000,100)
+	specs, x, y, frqs = bandSpecs(dtype,False)
+	plan = fdi2.planSigma2D(nRec,nSamples,dt,velocities,minFreq,maxFreq,dtype,memoryLimit=memoryLimit,blockBytes=2**23)
+	assert plan['fits']
+	measured = specs.nbytes+peakBytes(lambda: fdi2.sigma2DFromSpecs(specs,x,velocities,frqs,plan['blockSize']))
+	assert measured <= 1.02*plan['peakBytes']
+	assert measured >= 0.9*plan['peakBytes']
+	if memoryLimit is not None:
+		assert plan['peakBytes'] <= memoryLimit
+
+@pytest.mark.parametrize('dtype', [complex, np.complex64])
+def test_planSigma3D(dtype):
+	velocities = np.linspace(200,2000,30)
+	specs, x, y, frqs = bandSpecs(dtype,True)
+	plan = fdi3.planSigma3D(nRec,nSamples,dt,velocities,velocities[::2],minFreq,maxFreq,dtype,oneSided=True,memoryLimit=8*2**20)
+	assert plan['fits']
+	measured = specs.nbytes+peakBytes(lambda: fdi3.sigma3DFromSpecs(specs,x,y,velocities,velocities[::2],frqs,plan['blockSize']))
+	assert measured <= 1.02*plan['peakBytes']
+	assert measured >= 0.9*plan['peakBytes']
+
+def test_singlePrecisionTakesLessMemory():
+	velocities = np.linspace(200,2000,100)
+	# with the same blocks of receivers
+	measured = {}
+	for dtype in [complex, np.complex64]:
+		specs, x, y, frqs = bandSpecs(dtype,False)
+		measured[dtype] = specs.nbytes+peakBytes(lambda: fdi2.sigma2DFromSpecs(specs,x,velocities,frqs,20))
+	assert measured[np.complex64] < measured[complex]
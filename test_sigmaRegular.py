@@ -0,0 +1,57 @@
+########### Regression tests comparing the non-uniform FFT sigmas of regular arrays with the direct sums.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import numpy as np
+import pytest
+import traceClass as tr
+import fastDispImg2D as fdi2
+import fastDispImg3D as fdi3
+
+
+dt = 0.004
+nSamples = 500
+minFreq = 5.0
+maxFreq = 40.0
+velocities = np.linspace(150,2500,30)
+filterFunction = tr.filterChain(('whiten_spec',2))
+
+
+def relativeError(a, b):
+	return np.abs(a-b).max()/np.abs(b).max()
+
+
+@pytest.mark.parametrize('oneSided', [False, True])
+def test_sigma2DRegular(oneSided):
+	# a line with a gap and a shifted origin
+	rng = np.random.default_rng(7)
+	x = 35.0+4.0*np.array([0,1,2,3,5,6,7,8,9,12,13,14,15,16,17,18,19,20])
+	data = rng.standard_normal((x.size,nSamples))
+	expected = fdi2.sigma2D(tr.TraceGather(data,dt,x),velocities,minFreq,maxFreq,filterFunction,oneSided=oneSided)
+	sigma = fdi2.sigma2DRegular(tr.TraceGather(data,dt,x),velocities,minFreq,maxFreq,filterFunction,oneSided=oneSided)
+	assert sigma.shape == expected.shape
+	assert relativeError(sigma,expected) < 1e-9
+	sigma = fdi2.sigma2DRegular(tr.TraceGather(data,dt,x),velocities,minFreq,maxFreq,filterFunction,oneSided=oneSided,spreadWidth=16)
+	assert relativeError(sigma,expected) < 1e-11
+
+@pytest.mark.parametrize('oneSided', [False, True])
+def test_sigma3DRegular(oneSided):
+	# a 6 x 5 grid with two missing nodes
+	rng = np.random.default_rng(8)
+	gridX, gridY = np.meshgrid(np.arange(6)*5.0-12.0,np.arange(5)*7.0+3.0,indexing='ij')
+	keep = np.ones(gridX.size,dtype=bool)
+	keep[[4,17]] = False
+	x = gridX.ravel()[keep]
+	y = gridY.ravel()[keep]
+	data = rng.standard_normal((x.size,nSamples))
+	yvelocities = velocities[::2]
+	expected = fdi3.sigma3D(tr.TraceGather(data,dt,x,y),velocities,yvelocities,minFreq,maxFreq,filterFunction,oneSided=oneSided)
+	sigma = fdi3.sigma3DRegular(tr.TraceGather(data,dt,x,y),velocities,yvelocities,minFreq,maxFreq,filterFunction,oneSided=oneSided)
+	assert sigma.shape == expected.shape
+	assert relativeError(sigma,expected) < 1e-9
+
+def test_regularPositions():
+	x0, dx, m = fdi2.regularPositions(np.array([3.0,7.0,15.0,11.0]))
+	assert (x0, dx) == (3.0, 4.0)
+	assert list(m) == [0,1,3,2]
+	with pytest.raises(ValueError):
+		fdi2.regularPositions(np.array([0.0,4.0,9.0]))
@@ -0,0 +1,48 @@
+########### Regression tests for the lazy band-limited spectra of trace and TraceGather.
+########### Available at github.com/eileenrmartin/FastDispersionImages
+
+import numpy as np
+import pytest
+import traceClass as tr
+
+
+dt = 0.004
+nSamples = 1000
+
+
+def makeData():
+	'''Get a reproducible time series of nSamples random samples'''
+	return np.random.default_rng(13).standard_normal(nSamples)
+
+
+@pytest.mark.parametrize('frqRefinement', [1, 3])
+def test_bandSpecMatchesFullSpectrum(frqRefinement):
+	data = makeData()
+	lazy = tr.trace(data,dt,0.0,frqRefinement=frqRefinement)
+	full = tr.trace(data,dt,0.0,frqRefinement=frqRefinement)
+	full.dataSpec
+	for minFrqIdx, maxFrqIdx in [(0,40),(1,40),(7,300),(0,frqRefinement*nSamples//2+1)]:
+		expected = full.getPosSpec(minFrqIdx,maxFrqIdx)
+		assert np.abs(lazy.getPosSpec(minFrqIdx,maxFrqIdx)-expected).max() < 1e-12*np.abs(expected).max()
+
+def test_bandSpecDoesNotKeepFullSpectrum():
+	# a wide band takes the FFT path, whose band must not be a view of the whole spectrum
+	aTrace = tr.trace(np.random.default_rng(14).standard_normal(100000),dt,0.0)
+	band = aTrace.getPosSpec(100,40000)
+	assert tr.bandSpectrumMethod(aTrace.nSamples,band.size)[0] == 'fft'
+	owner = aTrace.bandSpec if aTrace.bandSpec.base is None else aTrace.bandSpec.base
+	assert owner.size == band.size
+
+@pytest.mark.parametrize('minFrqIdx', [0, 1, 5])
+def test_subsetSpecDoesNotDependOnFullSpectrum(minFrqIdx):
+	data = makeData()
+	lazy = tr.trace(data,dt,0.0)
+	full = tr.trace(data,dt,0.0)
+	full.dataSpec
+	oneSided = tr.trace(data,dt,0.0,oneSided=True)
+	oneSided.dataSpec
+	expected = tr.posNegFromPos(full.getPosSpec(minFrqIdx,40))
+	for aTrace in (lazy, full, oneSided):
+		subsetSpec = aTrace.getSubsetSpec(minFrqIdx,40)
+		assert subsetSpec.shape == (2*(40-minFrqIdx),)
+		assert np.abs(subsetSpec-expected).max() < 1e-12*np.abs(expected).max()
@@ -4,30 +4,23 @@
 
 import numpy as np
 import scipy.fftpack as ft
+import scipy.fft as sfft
+import dispImgProfile as dpf
 
-class trace:
 
+# default memory (bytes) used by one block of rows in batch FFTs of a gather
+defaultBlockBytes = 2**26
 
-	def __init__(self, data, dt, x, y=0):
-		'''data should be a 1d numpy array of floats representing a time series recorded at this receiver, dt should be seconds between samples in data (float), x is the x-position of this receiver in meters (float), y is the y-position of this receiver in meters (float). When dealing with a linear array, only include the x value.'''
-		self.data = data # time series data 
-		self.nSamples = data.size # length of data
-		self.dt = dt # time (s) between samples
-		self.x = x # x-position (m) of receiver
-		self.y = y # y-position (m) of receiver
-		self.dataSpec = None # will hold the spectrum
-		self.set_dataSpec() # set the spectrum
 
+class frequencyGrid:
+	'''Frequency bins of the spectrum of time series with nSamples samples spaced dt seconds apart, shared by trace and TraceGather. Subclasses set self.dt and self.nSamples, and may set self.frqRefinement to sample the spectrum frqRefinement times more finely than the FFT of nSamples samples.'''
 
-	def set_dataSpec(self):
-		'''Take an FFT of self.data and scale by number of samples'''
-		self.dataSpec = ft.fft(self.data)
-		self.dataSpec /= self.nSamples
+	frqRefinement = 1 # frequency bins per bin of the FFT of nSamples samples
 
 	def getNHzPerBin(self):
 		'''Get the number of Hz falling into each frequency bin in dataSpec'''
 		NyquistFrq = 0.5/self.dt # Nyquist frequency (Hz)
-		return NyquistFrq/(self.nSamples/2)
+		return NyquistFrq/(self.nSamples/2)/self.frqRefinement
 
 	def getIdxFromHz(self, freqHz):
 		'''Get the index in self.dataSpec of the positive frequency (Hz) specified by freqHz'''
@@ -39,6 +32,98 @@ class trace:
 		idx = int(freqHz/nHzPerBin) 
 		return idx
 
+	def getPosFrqs(self, minFrqIdx, maxFrqIdx):
+		'''Get the frequencies (Hz) of the entries returned by getPosSpec in the order minFreq,...,maxFreq'''
+		nFrq = maxFrqIdx-minFrqIdx
+		actualMinFrq = minFrqIdx*self.getNHzPerBin()
+		actualMaxFrq = maxFrqIdx*self.getNHzPerBin()
+		return np.linspace(actualMinFrq,actualMaxFrq,nFrq)
+
+	def getPosNegFrqs(self, minFrqIdx, maxFrqIdx):
+		'''Get the frequencies (Hz) of the entries returned by getSubsetSpec in the order minFreq,...,maxFreq,-maxFreq,...,-minFreq'''
+		posFrqs = self.getPosFrqs(minFrqIdx,maxFrqIdx)
+		return np.hstack((posFrqs,-1*np.flipud(posFrqs)))
+
+	def getBinFrqs(self, minFrqIdx, maxFrqIdx):
+		'''Get the frequencies (Hz) of the bins minFrqIdx,...,maxFrqIdx-1 of the non-negative half of the spectrum, as seen by the spectral filters'''
+		return np.arange(minFrqIdx,maxFrqIdx)*self.getNHzPerBin()
+
+
+
+class trace(frequencyGrid):
+
+
+	def __init__(self, data, dt, x, y=0, oneSided=False, dtype=complex, frqRefinement=1):
+		'''data should be a 1d numpy array of floats representing a time series recorded at this receiver, dt should be seconds between samples in data (float), x is the x-position of this receiver in meters (float), y is the y-position of this receiver in meters (float). When dealing with a linear array, only include the x value. The spectrum is not computed until it is used: getPosSpec and getSubsetSpec only evaluate the band they are asked for, while dataSpec holds the full spectrum and is computed on first use. If oneSided is True only the non-negative frequencies of the (real) data are transformed and stored in dataSpec, and negative frequencies are derived by conjugate symmetry when needed. dtype is the complex type of dataSpec (np.complex64 halves the memory of the spectrum and of everything computed from it, at single precision). frqRefinement (int) samples the spectrum that many times more finely than the FFT of the data, as if the data were zero-padded to frqRefinement times their length.'''
+		self.data = data # time series data 
+		self.nSamples = data.size # length of data
+		self.dt = dt # time (s) between samples
+		self.x = x # x-position (m) of receiver
+		self.y = y # y-position (m) of receiver
+		self.oneSided = oneSided # whether dataSpec only holds non-negative frequencies
+		self.dtype = np.dtype(dtype) # complex type of the spectrum
+		self.frqRefinement = frqRefinement # frequency bins per bin of the FFT of the data
+		self.fullSpec = None # will hold the full spectrum, once it is used
+		self.minFrqIdx = None # band of the stored band-limited spectrum
+		self.maxFrqIdx = None
+		self.bandSpec = None # will hold the positive band of the spectrum, once it is used
+
+	@property
+	def dataSpec(self):
+		'''the full spectrum of self.data, scaled by number of samples and computed on first use'''
+		if self.fullSpec is None:
+			self.set_dataSpec()
+		return self.fullSpec
+
+	@dataSpec.setter
+	def dataSpec(self, spec):
+		self.fullSpec = spec
+		self.bandSpec = None
+
+
+	def set_dataSpec(self):
+		'''Take an FFT of self.data (zero-padded to frqRefinement times its length) and scale by number of samples'''
+		nPadded = self.frqRefinement*self.nSamples
+		nSpec = nPadded//2+1 if self.oneSided else nPadded
+		with dpf.stage('trace.set_dataSpec', nSpec*self.dtype.itemsize, fftFlops(nPadded,self.oneSided)):
+			realData = np.asarray(self.data,dtype=np.finfo(self.dtype).dtype)
+			if(self.oneSided):
+				self.dataSpec = sfft.rfft(realData,nPadded).astype(self.dtype,copy=False) # non-negative frequencies of real data only
+			else:
+				self.dataSpec = ft.fft(realData,nPadded).astype(self.dtype,copy=False)
+			self.fullSpec /= self.nSamples
+
+	def set_bandSpec(self, minFrqIdx, maxFrqIdx):
+		'''Evaluate the spectrum of self.data, scaled by number of samples, only at the positive frequencies between the indices minFrqIdx and maxFrqIdx (from getIdxFromHz) and keep it in self.bandSpec, without forming the full spectrum (see bandSpectrum)'''
+		nFrq = maxFrqIdx-minFrqIdx
+		flops = bandSpectrumMethod(self.nSamples,nFrq,self.frqRefinement)[1]
+		with dpf.stage('trace.set_bandSpec', nFrq*self.dtype.itemsize, flops):
+			realData = np.asarray(self.data,dtype=np.finfo(self.dtype).dtype)
+			self.bandSpec = bandSpectrum(realData,minFrqIdx,maxFrqIdx,self.frqRefinement).astype(self.dtype,copy=False)
+			self.bandSpec /= self.nSamples
+		self.minFrqIdx = minFrqIdx
+		self.maxFrqIdx = maxFrqIdx
+
+	def reset_spec(self):
+		'''Forget the stored spectra after the data changed, so they are recomputed when next used'''
+		self.fullSpec = None
+		self.bandSpec = None
+
+	def getSubsetSpec(self, minFrqIdx, maxFrqIdx):
+		'''Get the part of self.dataSpec between the indices minFrqIdx and maxFrqIdx (from getIdxFromHz) in the order minFreq,...,maxFreq,-maxFreq,...,-minFreq. If minFrqIdx is 0 the band ends with bin 0 again (its own negative), as in posNegFromPos, whether or not the full spectrum was computed.'''
+		if(self.oneSided or self.fullSpec is None):
+			return posNegFromPos(self.getPosSpec(minFrqIdx,maxFrqIdx))
+		negIdx = -np.arange(maxFrqIdx-1,minFrqIdx-1,-1) % self.fullSpec.size
+		return np.hstack((self.fullSpec[minFrqIdx:maxFrqIdx],self.fullSpec[negIdx]))
+
+	def getPosSpec(self, minFrqIdx, maxFrqIdx):
+		'''Get the part of self.dataSpec between the indices minFrqIdx and maxFrqIdx (from getIdxFromHz) for positive frequencies only, in the order minFreq,...,maxFreq. Unless the full spectrum was already computed, only this band is evaluated (and only if it is not inside the stored one).'''
+		if(self.fullSpec is not None):
+			return self.fullSpec[minFrqIdx:maxFrqIdx]
+		if(self.bandSpec is None or minFrqIdx < self.minFrqIdx or maxFrqIdx > self.maxFrqIdx):
+			self.set_bandSpec(minFrqIdx,maxFrqIdx)
+		return self.bandSpec[minFrqIdx-self.minFrqIdx:maxFrqIdx-self.minFrqIdx]
+
 
 	#### Here's an example of a filter, but you ####
 	#### should add more filters. Things like   ####
@@ -49,5 +134,361 @@ class trace:
 	def scale_data(self,c):
 		'''Scale the data and the data spectrum by multiplying by c (a scalar float)'''
 		self.data = self.data*c
-		self.dataSpec = self.dataSpec*c
+		if(self.fullSpec is not None):
+			self.fullSpec = self.fullSpec*c
+		if(self.bandSpec is not None):
+			self.bandSpec = self.bandSpec*c
+
+	def taper_data(self, fraction=0.05):
+		'''Taper both ends of the data with a cosine ramp over fraction (float) of its samples, and update the spectrum'''
+		self.data = self.data*taperWindow(self.nSamples,fraction)
+		self.reset_spec()
+
+	def normalize_oneBit(self):
+		'''Replace the data by its sign (one-bit temporal normalization), and update the spectrum'''
+		self.data = np.sign(self.data)
+		self.reset_spec()
+
+	def normalize_runningAbsMean(self, halfWidth):
+		'''Divide the data by the mean of its absolute value over the 2*halfWidth+1 nearest samples (running-absolute-mean temporal normalization), and update the spectrum'''
+		self.data = runningAbsMeanNormalize(self.data,halfWidth)
+		self.reset_spec()
+
+	def whiten_spec(self, halfWidth=0):
+		'''Divide the spectrum by its amplitude averaged over the 2*halfWidth+1 nearest frequency bins (spectral whitening), and update the data'''
+		self.filter_spec(lambda spec, frqs: whiten(spec,halfWidth))
+
+	def bandpass_spec(self, lowFreq, highFreq, rampWidth=0.0):
+		'''Keep the frequencies between lowFreq and highFreq (Hz) of the spectrum, with cosine ramps rampWidth (Hz) wide outside them, and update the data'''
+		self.filter_spec(lambda spec, frqs: spec*bandpassWeights(frqs,lowFreq,highFreq,rampWidth).astype(np.finfo(self.dtype).dtype))
+
+	def filter_spec(self, function):
+		'''Replace the non-negative half of the spectrum of the (real) data by function(spec, frqs), where frqs are the frequencies (Hz) of the entries of spec, and update the data, as TraceGather does for its spectral filters. The filters see the FFT of the data itself whatever frqRefinement is, and the stored spectra are recomputed when next used.'''
+		realData = np.asarray(self.data,dtype=np.finfo(self.dtype).dtype)
+		spec = function(np.fft.rfft(realData)/self.nSamples,np.fft.rfftfreq(self.nSamples,self.dt))
+		self.data = np.fft.irfft(spec*self.nSamples,self.nSamples)
+		self.reset_spec()
+
+
+
+class TraceGather(frequencyGrid):
+
+
+	def __init__(self, data, dt, x, y=None, dtype=complex, frqRefinement=1):
+		'''data should be a 2D numpy array (or numpy memmap) of real floats nRec x nSamples where each row is the time series recorded at one receiver, dt should be seconds between samples in data (float), x is a 1D numpy array of the nRec x-positions of the receivers in meters, y is a 1D numpy array of the nRec y-positions of the receivers in meters. When dealing with a linear array, only include the x values. The spectrum is not computed until a band is requested, and then only the positive band is kept (negative frequencies follow by conjugate symmetry). dtype is the complex type of the spectra (np.complex64 for single precision). frqRefinement (int) samples the spectra that many times more finely than the FFT of the data, as in trace.'''
+		self.data = data # nRec x nSamples time series data, never modified in place
+		self.nRec = data.shape[0] # number of receivers
+		self.nSamples = data.shape[1] # length of each time series
+		self.dt = dt # time (s) between samples
+		self.x = np.asarray(x,dtype=float) # x-positions (m) of receivers
+		self.y = np.zeros(self.nRec) if y is None else np.asarray(y,dtype=float) # y-positions (m) of receivers
+		self.dtype = np.dtype(dtype) # complex type of the spectra
+		self.frqRefinement = frqRefinement # frequency bins per bin of the FFT of the data
+		self.minFrqIdx = None # band of the stored spectra
+		self.maxFrqIdx = None
+		self.bandSpec = None # will hold the nRec x nFrq positive band of the spectra
+		self.filters = [] # (timeDomain, function, reach) filters applied in order to the data before the spectra are kept, with (None, c, 0) for scaling by c
+
+
+	@classmethod
+	def fromFile(cls, path, nRec, nSamples, dt, x, y=None, dtype=np.float32, offset=0, specDtype=complex, frqRefinement=1):
+		'''Memory-map a binary file holding nRec x nSamples samples of type dtype (stored receiver by receiver, starting offset bytes into the file) as a read-only gather, so the data are only read from disk as the spectra are computed. dt, x, y and frqRefinement are as in __init__ and specDtype is the complex type of the spectra.'''
+		data = np.memmap(path,dtype=dtype,mode='r',offset=offset,shape=(nRec,nSamples))
+		return cls(data,dt,x,y,specDtype,frqRefinement)
+
+	@classmethod
+	def fromTraces(cls, traces):
+		'''Build a gather from a list of trace objects assumed to all have the same length traces with the same sampling rate'''
+		data = np.array([r.data for r in traces])
+		return cls(data,traces[0].dt,[r.x for r in traces],[r.y for r in traces],traces[0].dtype,traces[0].frqRefinement)
+
+	def __len__(self):
+		return self.nRec
+
+	def getTrace(self, i):
+		'''Get receiver number i as a trace object, for example to use it as the virtual source of dispImg2D or dispImg3D'''
+		data = self.filterBlock(np.asarray(self.data[i:i+1,:],dtype=float),self.filters)
+		return trace(data[0,:],self.dt,self.x[i],self.y[i],dtype=self.dtype,frqRefinement=self.frqRefinement)
+
+	def set_bandSpec(self, minFrqIdx, maxFrqIdx, blockSize=None):
+		'''Evaluate the spectra of all receivers in blocks of blockSize rows (by default about defaultBlockBytes of memory per block), scale by number of samples and keep only the positive frequencies between the indices minFrqIdx and maxFrqIdx (from getIdxFromHz) in self.bandSpec (see bandSpectrum)'''
+		if blockSize is None:
+			blockSize = max(1,int(defaultBlockBytes//(self.dtype.itemsize*self.nSamples*self.frqRefinement)))
+
+		# filters up to the last time-domain one run on the full-length data, spectral filters after it only on the band
+		# (on a refined grid spectral filters always see the unrefined spectrum, as on a trace)
+		nTimeFilters = max([i+1 for i, (timeDomain, function, reach) in enumerate(self.filters) if timeDomain]+[0])
+		if(self.frqRefinement > 1):
+			nTimeFilters = len(self.filters)
+
+		# widen the band by the bins the spectral filters look at beyond it, so they give the same as on the full spectrum
+		reach = sum(reach for timeDomain, function, reach in self.filters[nTimeFilters:])
+		lo = max(0,minFrqIdx-reach)
+		hi = min(self.frqRefinement*self.nSamples//2+1,maxFrqIdx+reach)
+		nFrq = hi-lo
+		flops = bandSpectrumMethod(self.nSamples,nFrq,self.frqRefinement)[1]
+
+		self.bandSpec = np.zeros((self.nRec,nFrq),dtype=self.dtype)
+		for start in range(0,self.nRec,blockSize):
+			nBlock = min(blockSize,self.nRec-start)
+			with dpf.stage('gather.filters', nBlock*self.nSamples*self.dtype.itemsize//2):
+				block = self.filterBlock(np.asarray(self.data[start:start+blockSize,:],dtype=np.finfo(self.dtype).dtype),self.filters[:nTimeFilters])
+			with dpf.stage('gather.fft', nBlock*nFrq*self.dtype.itemsize, nBlock*flops):
+				self.bandSpec[start:start+blockSize,:] = bandSpectrum(block,lo,hi,self.frqRefinement)
+		self.bandSpec /= self.nSamples
+		with dpf.stage('gather.filters', self.bandSpec.nbytes if len(self.filters) > nTimeFilters else 0):
+			for timeDomain, function, reach in self.filters[nTimeFilters:]:
+				if timeDomain is None:
+					self.bandSpec = (self.bandSpec*function).astype(self.dtype,copy=False)
+				else:
+					self.bandSpec = function(self.bandSpec,self.getBinFrqs(lo,hi)).astype(self.dtype,copy=False)
+		if(nFrq > maxFrqIdx-minFrqIdx):
+			self.bandSpec = self.bandSpec[:,minFrqIdx-lo:maxFrqIdx-lo].copy()
+		self.minFrqIdx = minFrqIdx
+		self.maxFrqIdx = maxFrqIdx
+
+	def filterBlock(self, block, filters):
+		'''Apply filters (a list of (timeDomain, function, reach) filters, see add_filter, and (None, c, 0) scalings from scale_data) in order to block, a 2D numpy array nRows x nSamples of real data, and return the filtered block. Spectral filters run on the full non-negative half of the spectrum here, with one FFT round trip per run of consecutive spectral filters.'''
+		blockSpec = None
+		for timeDomain, function, reach in filters:
+			if timeDomain is None:
+				# a scaling commutes with the FFT, so it applies to whichever form the data are in
+				if blockSpec is None:
+					block = (block*function).astype(block.dtype,copy=False)
+				else:
+					blockSpec = (blockSpec*function).astype(blockSpec.dtype,copy=False)
+			elif(timeDomain):
+				if blockSpec is not None:
+					block = sfft.irfft(blockSpec*self.nSamples,self.nSamples,axis=1).astype(block.dtype,copy=False)
+					blockSpec = None
+				block = function(block)
+			else:
+				if blockSpec is None:
+					blockSpec = sfft.rfft(block,axis=1)/self.nSamples # scaled like the stored spectra
+				blockSpec = function(blockSpec,np.fft.rfftfreq(self.nSamples,self.dt))
+		if blockSpec is not None:
+			block = sfft.irfft(blockSpec*self.nSamples,self.nSamples,axis=1).astype(block.dtype,copy=False)
+		return block
+
+	def getPosSpecs(self, minFrqIdx, maxFrqIdx):
+		'''Get the nRec x nFrq spectra of all receivers between the indices minFrqIdx and maxFrqIdx (from getIdxFromHz) for positive frequencies only, in the order minFreq,...,maxFreq. The spectra are only recomputed if this band is not inside the stored one.'''
+		if(self.bandSpec is None or minFrqIdx < self.minFrqIdx or maxFrqIdx > self.maxFrqIdx):
+			self.set_bandSpec(minFrqIdx,maxFrqIdx)
+		return self.bandSpec[:,minFrqIdx-self.minFrqIdx:maxFrqIdx-self.minFrqIdx]
+
+	def getSubsetSpecs(self, minFrqIdx, maxFrqIdx):
+		'''Get the nRec x 2*nFrq spectra of all receivers between the indices minFrqIdx and maxFrqIdx (from getIdxFromHz) in the order minFreq,...,maxFreq,-maxFreq,...,-minFreq'''
+		return posNegFromPos(self.getPosSpecs(minFrqIdx,maxFrqIdx))
+
+
+	#### Filters applied to the whole gather at once. ####
+	#### A filterFunction passed to sigma2D, sigma3D  ####
+	#### or the stacks is called once on the gather.  ####
+	#### The data array itself is never modified, so  ####
+	#### filters are recorded and applied in blocks   ####
+	#### of receivers as the spectra are computed.    ####
+	def scale_data(self,c):
+		'''Scale the data and the data spectra by multiplying by c (a scalar float). The data array itself is not modified, so memory-mapped files stay untouched; the scaling is recorded with the filters, in order.'''
+		self.filters.append((None,c,0))
+		if(self.bandSpec is not None):
+			self.bandSpec = self.bandSpec*c
+
+	def taper_data(self, fraction=0.05):
+		'''Taper both ends of every time series with a cosine ramp over fraction (float) of its samples'''
+		window = taperWindow(self.nSamples,fraction)
+		self.add_filter(True, lambda block: block*window.astype(block.dtype))
+
+	def normalize_oneBit(self):
+		'''Replace every time series by its sign (one-bit temporal normalization)'''
+		self.add_filter(True, np.sign)
+
+	def normalize_runningAbsMean(self, halfWidth):
+		'''Divide every time series by the mean of its absolute value over the 2*halfWidth+1 nearest samples (running-absolute-mean temporal normalization)'''
+		self.add_filter(True, lambda block: runningAbsMeanNormalize(block,halfWidth))
+
+	def whiten_spec(self, halfWidth=0):
+		'''Divide every spectrum by its amplitude averaged over the 2*halfWidth+1 nearest frequency bins (spectral whitening). The band in use is evaluated halfWidth bins wider on each side for the average, so the result does not depend on the band.'''
+		self.add_filter(False, lambda spec, frqs: whiten(spec,halfWidth), halfWidth)
+
+	def bandpass_spec(self, lowFreq, highFreq, rampWidth=0.0):
+		'''Keep the frequencies between lowFreq and highFreq (Hz) of every spectrum, with cosine ramps rampWidth (Hz) wide outside them'''
+		self.add_filter(False, lambda spec, frqs: spec*bandpassWeights(frqs,lowFreq,highFreq,rampWidth).astype(spec.real.dtype))
+
+	def add_filter(self, timeDomain, function, reach=0):
+		'''Append a custom filter to the ones applied to this gather. If timeDomain is True, function(block) gets a 2D numpy array nRows x nSamples of real data and returns it filtered. Otherwise function(spec, frqs) gets a 2D numpy array of rows of the non-negative half of the spectra (often only the band in use) and the 1D numpy array of their frequencies (Hz), and returns them filtered; reach (int) is how many bins on either side of a bin its output depends on (such as the halfWidth of whitening), and the band it gets is widened by that much. Spectral filters with no reach are applied directly to spectra that were already computed, while other filters make them be recomputed.'''
+		self.filters.append((timeDomain,function,reach))
+		if(timeDomain or reach > 0 or self.frqRefinement > 1):
+			self.bandSpec = None
+		elif(self.bandSpec is not None):
+			self.bandSpec = function(self.bandSpec,self.getBinFrqs(self.minFrqIdx,self.maxFrqIdx)).astype(self.dtype,copy=False)
+
+
+
+def bandSpectra(traces, minFreq, maxFreq, filterFunction, oneSided=False):
+	'''traces is a list of trace objects assumed to all have the same length traces with the same sampling rate, or a TraceGather. minFreq and maxFreq are the minimum/maximum positive frequencies of interest (Hz). filterFunction is a user-defined function that takes a single trace as input and filters it, and it is called once on each trace (or once on the whole TraceGather); filterChain() builds one from the filters of trace and TraceGather. This returns a tuple (subsetSpecs, x, y, posNegFrqs) where subsetSpecs is a 2D numpy array nRec x 2*nFrq holding the band-limited spectrum of each filtered trace in the order minFreq,...,maxFreq,-maxFreq,...,-minFreq, x and y are 1D numpy arrays of the nRec receiver positions (m), and posNegFrqs holds the 2*nFrq frequencies (Hz) of the columns of subsetSpecs. If oneSided is True only the positive band minFreq,...,maxFreq is returned, so subsetSpecs is nRec x nFrq and posNegFrqs holds nFrq frequencies.'''
+
+	# define dimensions of the band of interest
+	ref = traces if isinstance(traces,TraceGather) else traces[0]
+	minFrqIdx = ref.getIdxFromHz(minFreq)
+	maxFrqIdx = ref.getIdxFromHz(maxFreq)
+	nFrq = maxFrqIdx-minFrqIdx
+	nRec = len(traces)
+
+	# a gather is filtered and transformed as a whole
+	if(isinstance(traces,TraceGather)):
+		with dpf.stage('filterFunction'):
+			filterFunction(traces) # call user-defined filters
+		if(oneSided):
+			return traces.getPosSpecs(minFrqIdx,maxFrqIdx), traces.x, traces.y, traces.getPosFrqs(minFrqIdx,maxFrqIdx)
+		with dpf.stage('spectrum slicing', 2*nRec*nFrq*traces.dtype.itemsize):
+			subsetSpecs = traces.getSubsetSpecs(minFrqIdx,maxFrqIdx)
+		return subsetSpecs, traces.x, traces.y, traces.getPosNegFrqs(minFrqIdx,maxFrqIdx)
+
+	# stack the band-limited spectra of all filtered traces
+	nCols = nFrq if oneSided else 2*nFrq
+	subsetSpecs = np.zeros((nRec,nCols),dtype=ref.dtype)
+	x = np.zeros(nRec)
+	y = np.zeros(nRec)
+	for i, r in enumerate(traces):
+		with dpf.stage('filterFunction'):
+			filterFunction(r) # call user-defined filters
+		with dpf.stage('spectrum slicing', nCols*ref.dtype.itemsize):
+			if(oneSided):
+				subsetSpecs[i,:] = r.getPosSpec(minFrqIdx,maxFrqIdx)
+			else:
+				subsetSpecs[i,:] = r.getSubsetSpec(minFrqIdx,maxFrqIdx)
+		x[i] = r.x
+		y[i] = r.y
+
+	if(oneSided):
+		return subsetSpecs, x, y, traces[0].getPosFrqs(minFrqIdx,maxFrqIdx)
+	return subsetSpecs, x, y, traces[0].getPosNegFrqs(minFrqIdx,maxFrqIdx)
+
+
+
+def posNegFromPos(posBand):
+	'''posBand is a numpy array whose last axis holds values at the positive frequencies minFreq,...,maxFreq of a real time series (a band-limited spectrum, or a one-sided sigma). This returns the array extended along its last axis to minFreq,...,maxFreq,-maxFreq,...,-minFreq, with the negative band given by conjugate symmetry.'''
+	return np.concatenate((posBand,np.conj(posBand[...,::-1])),axis=-1)
+
+
+
+def fftFlops(nSamples, real=False):
+	'''Get the usual estimate 5*n*log2(n) of the floating-point operations of a complex FFT of nSamples samples, or half of it for the FFT of real data'''
+	flops = 5*nSamples*np.log2(max(nSamples,2))
+	return flops/2 if real else flops
+
+
+
+def bandSpectrumMethod(nSamples, nFrq, frqRefinement=1):
+	'''Choose how bandSpectrum evaluates nFrq bins of the spectrum of nSamples real samples on a grid frqRefinement times finer than their FFT. This returns a tuple (method, flops) of the cheapest of 'fft' (a real FFT zero-padded to frqRefinement*nSamples samples, then sliced), 'dft' (a direct sum over the samples for each bin) and 'chirpZ' (see chirpZ), and the floating-point operations it takes per time series.'''
+	costs = {'fft':fftFlops(frqRefinement*nSamples,True), 'dft':8*nSamples*nFrq, 'chirpZ':2*fftFlops(ft.next_fast_len(nSamples+nFrq-1))+12*(nSamples+nFrq)}
+	method = min(('fft','dft','chirpZ'), key=lambda m: costs[m])
+	return method, costs[method]
+
+def bandSpectrum(data, minFrqIdx, maxFrqIdx, frqRefinement=1):
+	'''data is a numpy array whose last axis holds nSamples samples of real time series. This returns the (unscaled) spectra along the last axis at the bins minFrqIdx,...,maxFrqIdx-1 of a frequency grid frqRefinement (int) times finer than the FFT of nSamples samples, the same as np.fft.rfft(data,frqRefinement*nSamples)[...,minFrqIdx:maxFrqIdx] but computed by the cheapest method of bandSpectrumMethod, so a narrow band or a finely sampled one does not need the full (zero-padded) spectrum. The FFTs are taken with scipy.fft, which keeps single precision data in single precision instead of working on a double precision copy.'''
+	nSamples = data.shape[-1]
+	nPadded = frqRefinement*nSamples
+	method = bandSpectrumMethod(nSamples,maxFrqIdx-minFrqIdx,frqRefinement)[0]
+	if(method == 'fft'):
+		return sfft.rfft(data,nPadded,axis=-1)[...,minFrqIdx:maxFrqIdx].copy() # so the full spectrum is not kept alive by the band
+	if(method == 'dft'):
+		# exact phases from the integer products of sample and bin indices
+		phases = np.outer(np.arange(nSamples),np.arange(minFrqIdx,maxFrqIdx)) % nPadded
+		return np.dot(data,np.exp((-2j*np.pi/nPadded)*phases).astype(np.result_type(data.dtype,np.complex64),copy=False))
+	return chirpZ(data,minFrqIdx/nPadded,1.0/nPadded,maxFrqIdx-minFrqIdx)
+
+def chirpZ(data, startCycles, stepCycles, nFrq):
+	'''data is a numpy array whose last axis holds nSamples samples. This returns the chirp-z (zoom) transform along the last axis, sum over n of data[...,n]*exp(-2*pi*i*(startCycles+m*stepCycles)*n) for m=0,...,nFrq-1, where startCycles and stepCycles are frequencies in cycles per sample. It is computed with Bluestein's algorithm as a convolution by FFTs of about nSamples+nFrq samples.'''
+	nSamples = data.shape[-1]
+	nFFT = ft.next_fast_len(nSamples+nFrq-1)
+	complexType = np.result_type(data.dtype,np.complex64)
+	n = np.arange(nSamples)
+	m = np.arange(nFrq)
+
+	# n*m = (n**2+m**2-(m-n)**2)/2 turns the sum into a convolution with a chirp
+	chirped = data*unitPhases(-(startCycles*n+0.5*stepCycles*n*n)).astype(complexType,copy=False)
+	lags = np.arange(1-nSamples,nFrq)
+	kernel = np.zeros(nFFT,dtype=complexType)
+	kernel[:nFrq] = unitPhases(0.5*stepCycles*m*m)
+	kernel[nFFT-nSamples+1:] = unitPhases(0.5*stepCycles*lags[:nSamples-1]**2)
+	conv = sfft.ifft(sfft.fft(chirped,nFFT,axis=-1)*sfft.fft(kernel),axis=-1)[...,:nFrq]
+	return conv*unitPhases(-0.5*stepCycles*m*m).astype(complexType,copy=False)
+
+def unitPhases(cycles):
+	'''Get exp(2*pi*i*cycles) for a numpy array of phases in cycles, reduced to [0,1) first so large phases keep their precision'''
+	return np.exp(2j*np.pi*np.remainder(cycles,1.0))
+
+
+
+def sumAmplitudeSpectra(subsetSpecs, memoryBudget=None):
+	'''subsetSpecs is a 2D numpy array nSrc x nCols of band-limited spectra (as returned by bandSpectra). This returns the 1D numpy array of the nCols amplitude spectra |spectrum| summed over all rows, taken in blocks of rows using about memoryBudget bytes (int, defaults to defaultBlockBytes).'''
+	if memoryBudget is None:
+		memoryBudget = defaultBlockBytes
+	amplitudes = np.zeros(subsetSpecs.shape[1],dtype=np.finfo(subsetSpecs.dtype).dtype)
+	blockSize = max(1,int(memoryBudget//(subsetSpecs.itemsize*subsetSpecs.shape[1])))
+	with dpf.stage('source amplitudes', amplitudes.nbytes, 6*subsetSpecs.size):
+		for start in range(0,subsetSpecs.shape[0],blockSize):
+			amplitudes += np.sum(np.absolute(subsetSpecs[start:start+blockSize,:]),axis=0)
+	return amplitudes
+
+
+
+def filterChain(*steps):
+	'''steps are tuples (filterName, arg1, arg2, ...) naming filters of trace and TraceGather with their arguments, for example ('bandpass_spec', 1.0, 30.0), ('normalize_oneBit',) and ('whiten_spec', 5). This returns a filterFunction for sigma2D, sigma3D and the stacks that applies the steps in order to each trace, or to a whole TraceGather in one vectorized pass per block of receivers.'''
+	def filterFunction(traces):
+		for step in steps:
+			getattr(traces,step[0])(*step[1:])
+	return filterFunction
+
+
+
+def taperWindow(nSamples, fraction):
+	'''Get a 1D numpy array of nSamples weights that rise from 0 to 1 with a cosine ramp over the first fraction (float) of the samples and fall back to 0 over the last fraction'''
+	window = np.ones(nSamples)
+	nTaper = int(fraction*nSamples)
+	if(nTaper > 0):
+		ramp = 0.5*(1-np.cos(np.pi*(np.arange(nTaper)+0.5)/nTaper))
+		window[:nTaper] = ramp
+		window[nSamples-nTaper:] = ramp[::-1]
+	return window
+
+
+
+def runningMean(values, halfWidth):
+	'''Get the mean of the numpy array values over the 2*halfWidth+1 nearest entries along its last axis (fewer at the ends), of the same type as values'''
+	n = values.shape[-1]
+	cumulative = np.zeros(values.shape[:-1]+(n+1,))
+	np.cumsum(values,axis=-1,out=cumulative[...,1:])
+	lo = np.maximum(np.arange(n)-halfWidth,0)
+	hi = np.minimum(np.arange(n)+halfWidth+1,n)
+	return ((cumulative[...,hi]-cumulative[...,lo])/(hi-lo)).astype(values.dtype,copy=False)
+
+
+
+def runningAbsMeanNormalize(data, halfWidth):
+	'''Divide the numpy array data by the mean of its absolute value over the 2*halfWidth+1 nearest samples along its last axis, leaving silent stretches at zero'''
+	scale = runningMean(np.absolute(data),halfWidth)
+	return np.divide(data,scale,out=np.zeros_like(data),where=scale>0)
+
+
+
+def whiten(spec, halfWidth=0):
+	'''Divide the complex numpy array spec by its amplitude averaged over the 2*halfWidth+1 nearest entries along its last axis, leaving zero entries at zero'''
+	amplitude = np.absolute(spec)
+	if(halfWidth > 0):
+		amplitude = runningMean(amplitude,halfWidth)
+	return np.divide(spec,amplitude,out=np.zeros_like(spec),where=amplitude>0)
+
+
 
+def bandpassWeights(frqs, lowFreq, highFreq, rampWidth=0.0):
+	'''Get the weights of a bandpass filter at the frequencies frqs (Hz, a numpy array, negative ones are mirrored): 1 between lowFreq and highFreq, falling to 0 with cosine ramps rampWidth (Hz) wide outside them, and 0 elsewhere'''
+	f = np.absolute(frqs)
+	weights = ((f >= lowFreq) & (f <= highFreq)).astype(float)
+	if(rampWidth > 0):
+		below = (f < lowFreq) & (f > lowFreq-rampWidth)
+		above = (f > highFreq) & (f < highFreq+rampWidth)
+		weights[below] = 0.5*(1+np.cos(np.pi*(lowFreq-f[below])/rampWidth))
+		weights[above] = 0.5*(1+np.cos(np.pi*(f[above]-highFreq)/rampWidth))
+	return weights